@@ -55,7 +55,7 @@ print(len(label_val))
 # 
 # Let’s create a dataset class for our action recognition dataset. We will read images in __getitem__. This is memory efficient because all the images are not stored in the memory at once but read as required.
 # 
-# Sample of our dataset will be a dict {'image':image,'img_path':img_path,'Label':Label}. Our datset will take an optional argument transform so that any required processing can be applied on the sample. 
+# Sample of our dataset will be a dict {'image':image,'img_path':img_path,'Label':Label,'idx':idx}, where idx is the position of the sample in the dataset (used to key per-sample caches). Our datset will take an optional argument transform so that any required processing can be applied on the sample. 
 
 # In[3]:
 
@@ -79,22 +79,28 @@ class ActionDataset(Dataset):
         return self.length*3
 
     def __getitem__(self, idx):
-        
+        return self.load_sample(idx, self.file_paths(idx))
+
+    def file_paths(self, idx):
         folder=int(idx/3)+1
         imidx=idx%3+1
         folder=format(folder,'05d')
         imgname=str(imidx)+'.jpg'
-        img_path = os.path.join(self.root_dir,
-                                folder,imgname)
-        image = Image.open(img_path)
+        return [os.path.join(self.root_dir,
+                             folder,imgname)]
+
+    def load_sample(self, idx, files):
+        # files are the paths from file_paths(idx), or file objects holding their bytes
+        img_path = self.file_paths(idx)[0]
+        image = Image.open(files[0])
         if len(self.labels)!=0:
             Label=self.labels[int(idx/3)][0]-1
         if self.transform:
             image = self.transform(image)
         if len(self.labels)!=0:
-            sample={'image':image,'img_path':img_path,'Label':Label}
+            sample={'image':image,'img_path':img_path,'Label':Label,'idx':idx}
         else:
-            sample={'image':image,'img_path':img_path}
+            sample={'image':image,'img_path':img_path,'idx':idx}
         return sample
   
 
@@ -343,46 +349,217 @@ for t, sample in enumerate(image_dataloader_train):
 # In[14]:
 
 
-def train(model, loss_fn, optimizer, dataloader, num_epochs = 1):
-    for epoch in range(num_epochs):
+# train_loop and evaluate take a get_batch function that turns a sample from the dataloader into
+# the (input, target) Variables for the model, so the same loops serve images, clips and the GPU.
+def image_batch(sample):
+    return Variable(sample['image']), Variable(sample['Label'].long())
+
+def per_sample_losses(loss_fn, scores, target):
+    '''
+    loss_fn without the batch reduction, one loss per sample. loss_fn must have a reduction
+    attribute, as nn.CrossEntropyLoss and DistillationLoss do.
+    '''
+    if not hasattr(loss_fn, 'reduction'):
+        raise ValueError('%s has no reduction attribute and cannot give per-sample losses'
+                         % loss_fn.__class__.__name__)
+    reduction, loss_fn.reduction = loss_fn.reduction, 'none'
+    try:
+        return loss_fn(scores, target)
+    finally:
+        loss_fn.reduction = reduction
+
+def train_loop(model, loss_fn, optimizer, dataloader, get_batch, num_epochs = 1, sampler=None,
+               val_loader=None, val_every=None, val_every_epochs=None, val_samples=None, num_classes=10,
+               checkpointer=None, resume=True, metrics=None, accum_steps=1, scheduler=None, max_lr=None):
+    '''
+    Returns the running training statistics of the last epoch: 'loss', 'acc', and the
+    per-class 'correct' and 'total' counts. They are accumulated from the scores of the
+    training forward pass, so there is no second pass over the training set; keep in mind
+    they are measured in training mode while the weights are still changing.
+    If val_loader is given, validation runs every val_every steps and/or at the end of every
+    val_every_epochs epochs, on a random subset of val_samples samples if val_samples is set.
+    The accuracies are collected in 'val_acc'.
+    If checkpointer (an AsyncCheckpointer) is given, a checkpoint is written every
+    checkpointer.every steps and at the end of training, and with resume=True training
+    continues from the newest one at exactly the step and data position where it stopped. Exact data order needs a
+    sampler with set_epoch/skip/state_dict, such as ResumableRandomSampler, or a batch
+    sampler with set_epoch/skip_batches/state_dict, such as BucketBatchSampler.
+    If metrics (a Telemetry) is given, step timings, throughput and the epoch statistics
+    are recorded in it and exported.
+    With accum_steps > 1 the gradients of accum_steps consecutive batches are summed into one
+    optimizer step, for an effective batch of accum_steps * batch_size; the batches of an
+    incomplete last window of an epoch do not make a step. Steps (val_every, checkpoints)
+    count optimizer steps. scheduler, e.g. from warmup_schedule, is stepped after every
+    optimizer step and saved in the checkpoints. max_lr (e.g. from lr_range_test) instead
+    makes one_cycle_schedule the scheduler, with one cycle over the num_epochs epochs.
+    '''
+    val_acc = []
+    stats = None
+    step = 0
+    saved_step = 0
+    start_epoch, skip_batches = 0, 0
+    running = None
+    if max_lr is not None and scheduler is None:
+        scheduler = one_cycle_schedule(optimizer, max_lr, num_epochs * (len(dataloader) // accum_steps))
+    data_sampler = getattr(dataloader, 'batch_sampler', None)
+    if not hasattr(data_sampler, 'set_epoch'):
+        data_sampler = dataloader.sampler
+    if checkpointer is not None and resume:
+        checkpoint = checkpointer.load_latest()
+        if checkpoint is not None:
+            step, start_epoch, skip_batches = restore_checkpoint(checkpoint, model, optimizer, data_sampler, scheduler)
+            saved_step = step
+            running, val_acc = checkpoint['running'], checkpoint['val_acc']
+            print('Resuming from step %d (epoch %d, batch %d)' % (step, start_epoch + 1, skip_batches))
+    for epoch in range(start_epoch, num_epochs):
         print('Starting epoch %d / %d' % (epoch + 1, num_epochs))
         model.train()
-        for t, sample in enumerate(dataloader):
-            x_var = Variable(sample['image'])
-            y_var = Variable(sample['Label'].long())
+        for source in (data_sampler, dataloader.dataset):
+            if hasattr(source, 'set_epoch'):
+                source.set_epoch(epoch)
+        if skip_batches and hasattr(data_sampler, 'skip_batches'):
+            data_sampler.skip_batches(skip_batches)
+        elif skip_batches and hasattr(data_sampler, 'skip'):
+            data_sampler.skip(skip_batches * dataloader.batch_size)
+        # kept as tensors on the device of the labels and updated with scatter_add_, which
+        # unlike boolean indexing or bincount does not wait for the GPU on every step
+        loss_sum, class_correct, class_total = running if running is not None else (0, None, None)
+        running = None
+        if metrics is not None:
+            metrics.start('train')
+        batches_done = skip_batches
+        for t, sample in enumerate(dataloader, skip_batches):
+            batches_done = t + 1
+            if metrics is not None:
+                metrics.batch_ready()
+            x_var, y_var = get_batch(sample)
 
             scores = model(x_var)
             
-            loss = loss_fn(scores, y_var)
+            if sampler is None:
+                loss = loss_fn(scores, y_var)
+                batch_loss = loss.data * scores.size(0)
+            else:
+                # sampler is the LossImportanceSampler of dataloader: feed it the per-sample losses
+                # and weight them by 1 / (N * p) so the gradient stays unbiased
+                losses = per_sample_losses(loss_fn, scores, y_var)
+                sampler.update(sample['idx'], losses.data)
+                loss = (losses * sampler.weights(sample['idx']).to(losses.device)).mean()
+                # the statistics report the true training loss, not the weighted one
+                batch_loss = losses.data.sum()
             if (t + 1) % print_every == 0:
-                print('t = %d, loss = %.4f' % (t + 1, loss.data[0]))
+                print('t = %d, loss = %.4f' % (t + 1, loss.item()))
+
+            if t % accum_steps == 0:
+                optimizer.zero_grad()
+            # the summed gradients of the window are the gradient of its mean loss
+            (loss / accum_steps if accum_steps > 1 else loss).backward()
+
+            labels = (y_var[0] if isinstance(y_var, tuple) else y_var).data
+            preds = scores.data.max(1)[1]
+            loss_sum += batch_loss
+            if class_total is None:
+                class_correct = torch.zeros(num_classes, dtype=torch.long, device=labels.device)
+                class_total = torch.zeros(num_classes, dtype=torch.long, device=labels.device)
+            class_correct.scatter_add_(0, labels, (preds == labels).long())
+            class_total.scatter_add_(0, labels, torch.ones_like(labels))
+            if (t + 1) % accum_steps != 0:
+                if metrics is not None:
+                    metrics.step_done(labels.size(0))
+                continue
 
-            optimizer.zero_grad()
-            loss.backward()
             optimizer.step()
-
-def check_accuracy(model, loader):
+            if scheduler is not None:
+                scheduler.step()
+            step += 1
+            validate = val_loader is not None and val_every and step % val_every == 0
+            if validate:
+                if metrics is not None:
+                    # the step ends here, the evaluation is timed on its own
+                    metrics.step_done(labels.size(0))
+                val_acc.append(evaluate(model, subset_loader(val_loader, val_samples), get_batch, metrics))
+                model.train()
+            if checkpointer is not None and checkpointer.due(step):
+                checkpointer.save(step, training_state(model, optimizer, data_sampler, step, epoch, t + 1,
+                                                       (loss_sum, class_correct, class_total), val_acc, scheduler))
+                saved_step = step
+            if metrics is not None:
+                # the update and the checkpoint snapshot are part of the step, not of the next data wait
+                if validate:
+                    metrics.start('train')
+                else:
+                    metrics.step_done(labels.size(0))
+        skip_batches = 0
+        epoch_running = (loss_sum, class_correct, class_total)
+
+        class_correct, class_total = class_correct.cpu().numpy(), class_total.cpu().numpy()
+        num_correct, num_samples = int(class_correct.sum()), int(class_total.sum())
+        stats = {'loss': float(loss_sum) / num_samples, 'acc': float(num_correct) / num_samples,
+                 'correct': class_correct, 'total': class_total, 'val_acc': val_acc}
+        print('Training (running): loss = %.4f, got %d / %d correct (%.2f)'
+              % (stats['loss'], num_correct, num_samples, 100 * stats['acc']))
+        if val_loader is not None and val_every_epochs and (epoch + 1) % val_every_epochs == 0:
+            val_acc.append(evaluate(model, subset_loader(val_loader, val_samples), get_batch, metrics))
+        if metrics is not None:
+            metrics.set('epoch', epoch + 1)
+            metrics.set('loss', stats['loss'], 'train')
+            metrics.set('accuracy', stats['acc'], 'train')
+            metrics.export()
+    if checkpointer is not None and step != saved_step:
+        # the final weights, so that a later run (or warm_start) starts from the end of this one
+        checkpointer.save(step, training_state(model, optimizer, data_sampler, step, num_epochs - 1, batches_done,
+                                               epoch_running, val_acc, scheduler))
+    if checkpointer is not None:
+        checkpointer.wait()
+    return stats
+
+def subset_loader(loader, num_samples=None):
     '''
-    if loader.dataset.train:
-        print('Checking accuracy on validation set')
-    else:
-        print('Checking accuracy on test set')  
+    loader itself, or a loader over a fresh random subset of num_samples of its samples.
     '''
+    if num_samples is None or num_samples >= len(loader.dataset):
+        return loader
+    idx = torch.randperm(len(loader.dataset))[:num_samples].tolist()
+    batch_size = loader.batch_size or getattr(loader.batch_sampler, 'batch_size', 1)
+    return DataLoader(torch.utils.data.Subset(loader.dataset, idx), batch_size=batch_size,
+                      shuffle=False, num_workers=loader.num_workers, collate_fn=loader.collate_fn)
+
+def evaluate(model, loader, get_batch, metrics=None):
     num_correct = 0
     num_samples = 0
     model.eval() # Put the model in test mode (the opposite of model.train(), essentially)
-    for t, sample in enumerate(loader):
-        x_var = Variable(sample['image'])
-        y_var = sample['Label']
-        #y_var=y_var.cpu()
-        scores = model(x_var)
-        _, preds = scores.data.max(1)#scores.data.cpu().max(1)
-        #print(preds)
-        #print(y_var)
-        num_correct += (preds.numpy() == y_var.numpy()).sum()
-        num_samples += preds.size(0)
+    eval_start = timeit.default_timer()
+    if metrics is not None:
+        metrics.start('eval')
+    with torch.no_grad():
+        for t, sample in enumerate(loader):
+            if metrics is not None:
+                metrics.batch_ready()
+            x_var, y_var = get_batch(sample)
+            scores = model(x_var)
+            _, preds = scores.data.cpu().max(1)
+            num_correct += (preds.numpy() == y_var.data.cpu().numpy()).sum()
+            num_samples += preds.size(0)
+            if metrics is not None:
+                metrics.step_done(preds.size(0))
     acc = float(num_correct) / num_samples
+    if metrics is not None:
+        metrics.observe('eval_seconds', timeit.default_timer() - eval_start)
+        metrics.set('accuracy', acc, 'eval')
     print('Got %d / %d correct (%.2f)' % (num_correct, num_samples, 100 * acc))
+    return acc
+
+def train(model, loss_fn, optimizer, dataloader, num_epochs = 1, **kwargs):
+    return train_loop(model, loss_fn, optimizer, dataloader, image_batch, num_epochs, **kwargs)
+
+def check_accuracy(model, loader, metrics=None):
+    '''
+    if loader.dataset.train:
+        print('Checking accuracy on validation set')
+    else:
+        print('Checking accuracy on test set')  
+    '''
+    return evaluate(model, loader, image_batch, metrics)
     
     
 
@@ -403,8 +580,7 @@ torch.random.manual_seed(12345)
 fixed_model.cpu()
 fixed_model.apply(reset) 
 fixed_model.train() 
-train(fixed_model, loss_fn, optimizer,image_dataloader_train, num_epochs=1) 
-check_accuracy(fixed_model, image_dataloader_train)# check accuracy on the training set
+train_stats = train(fixed_model, loss_fn, optimizer,image_dataloader_train, num_epochs=1) # also prints the running accuracy on the training set
 
 
 # ### Don't forget the validation set!
@@ -633,47 +809,20 @@ optimizer = optim.Adam(fixed_model_gpu.parameters(), lr=1e-5)
 # In[45]:
 
 
-def train(model, loss_fn, optimizer, dataloader, num_epochs = 1):
-    for epoch in range(num_epochs):
-        print('Starting epoch %d / %d' % (epoch + 1, num_epochs))
-        check_accuracy(fixed_model_gpu, image_dataloader_val)
-        model.train()
-        for t, sample in enumerate(dataloader):
-            x_var = Variable(sample['image'].cuda())
-            y_var = Variable(sample['Label'].cuda().long())
+def image_batch_gpu(sample):
+    return Variable(sample['image'].cuda()), Variable(sample['Label'].cuda().long())
 
-            scores = model(x_var)
-            
-            loss = loss_fn(scores, y_var)
-            if (t + 1) % print_every == 0:
-                print('t = %d, loss = %.4f' % (t + 1, loss.data[0]))
+def train(model, loss_fn, optimizer, dataloader, num_epochs = 1, **kwargs):
+    return train_loop(model, loss_fn, optimizer, dataloader, image_batch_gpu, num_epochs, **kwargs)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-def check_accuracy(model, loader):
+def check_accuracy(model, loader, metrics=None):
     '''
     if loader.dataset.train:
         print('Checking accuracy on validation set')
     else:
         print('Checking accuracy on test set')  
     '''
-    num_correct = 0
-    num_samples = 0
-    model.eval() # Put the model in test mode (the opposite of model.train(), essentially)
-    for t, sample in enumerate(loader):
-        x_var = Variable(sample['image'].cuda())
-        y_var = sample['Label'].cuda()
-        y_var=y_var.cpu()
-        scores = model(x_var)
-        _, preds = scores.data.cpu().max(1)
-        #print(preds)
-        #print(y_var)
-        num_correct += (preds.numpy() == y_var.numpy()).sum()
-        num_samples += preds.size(0)
-    acc = float(num_correct) / num_samples
-    print('Got %d / %d correct (%.2f)' % (num_correct, num_samples, 100 * acc))
+    return evaluate(model, loader, image_batch_gpu, metrics)
 
 
 # Run on GPU!
@@ -685,23 +834,58 @@ torch.cuda.random.manual_seed(12345)
 
 fixed_model_gpu.apply(reset) 
 fixed_model_gpu.train() 
-train(fixed_model_gpu, loss_fn, optimizer,image_dataloader_train, num_epochs=5) 
-check_accuracy(fixed_model_gpu, image_dataloader_train)# check accuracy on the training set
-
-
-# In[50]:
-
-
-check_accuracy(fixed_model_gpu, image_dataloader_val)
+# validate at the end of every epoch; the running training accuracy is printed along with it
+train_stats = train(fixed_model_gpu, loss_fn, optimizer,image_dataloader_train, num_epochs=5,
+                    val_loader=image_dataloader_val, val_every_epochs=1) 
 
 
 # ### 3D Convolution on video clips (25 points+10 extra points)
 # 3D convolution is for videos, it has one more dimension than 2d convolution. You can find the document for 3D convolution here http://pytorch.org/docs/master/nn.html#torch.nn.Conv3dIn. In our dataset, each clip is a video of 3 frames. Lets classify the each clip rather than each image using 3D convolution.
 # We offer the data loader, the train_3d and check_accuracy
+# 
+# The dataset returns each clip as raw uint8 frames (T x H x W x C). train_3d, check_accuracy_3d and predict_on_test_3d pass every batch through clip_preprocess, which converts it to float, scales it to 0-1 like T.ToTensor() does for the images, and lays it out as N x C x T x H x W, the order nn.Conv3d expects, in a single pass into a reused buffer.
 
 # In[53]:
 
 
+def make_clip(clip, transform=None):
+    '''
+    Turn the list of decoded frames of a clip into the clip returned by the datasets:
+    with a transform, a uint8 tensor of T x H x W x C. Conversion to float, scaling and
+    the C x T x H x W layout for nn.Conv3d happen per batch in ClipPreprocessor.
+    '''
+    if transform:
+        clip = torch.from_numpy(np.stack(clip))
+    return clip
+
+class ClipPreprocessor(object):
+    """Converts a uint8 batch of clips to normalized float N x C x T x H x W in one pass."""
+
+    def __init__(self, mean=(0.0, 0.0, 0.0), std=(1.0, 1.0, 1.0)):
+        """
+        Args:
+            mean, std (sequence): per-channel statistics on the 0-1 scale. The defaults only
+                scale to 0-1, exactly like T.ToTensor() does for ActionDataset.
+        """
+        std = torch.Tensor(std).view(1, -1, 1, 1, 1)
+        # (x / 255 - mean) / std == x * scale + shift
+        self.scale = 1.0 / (255.0 * std)
+        self.shift = -torch.Tensor(mean).view(1, -1, 1, 1, 1) / std
+        self.buffer = None
+
+    def __call__(self, clips):
+        '''
+        clips is N x T x H x W x C. The result lives in a buffer that is reused by the next
+        call, so it must not be kept across batches (train_loop and evaluate never do).
+        '''
+        N, D, H, W, C = clips.size()
+        if self.buffer is None or self.buffer.size() != (N, C, D, H, W):
+            self.buffer = torch.empty(N, C, D, H, W)
+        # the permuted view is read directly: the cast, scaling, normalization and the new layout are one kernel
+        return torch.addcmul(self.shift, clips.permute(0, 4, 1, 2, 3), self.scale, out=self.buffer)
+
+clip_preprocess = ClipPreprocessor()
+
 class ActionClipDataset(Dataset):
     """Action Landmarks dataset."""
 
@@ -718,33 +902,53 @@ class ActionClipDataset(Dataset):
         self.transform = transform
         self.length=len(os.listdir(self.root_dir))
         self.labels=labels
+        # counted once here rather than per clip and per worker process: on network storage
+        # every directory listing is a round trip
+        self.frame_counts=[self.count_frames(idx) for idx in range(self.length)]
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, idx):
-        
+        return self.load_sample(idx, self.file_paths(idx))
+
+    def count_frames(self, idx):
+        # clips may hold any number of frames 1.jpg ... n.jpg
+        folder=os.path.join(self.root_dir,format(idx+1,'05d'))
+        return len([name for name in os.listdir(folder) if name.endswith('.jpg')])
+
+    def frame_count(self, idx):
+        return self.frame_counts[idx]
+
+    def clip_lengths(self):
+        return list(self.frame_counts)
+
+    def file_paths(self, idx):
+        folder=format(idx+1,'05d')
+        paths=[]
+        for i in range(self.frame_count(idx)):
+            imidx=i+1
+            imgname=str(imidx)+'.jpg'
+            paths.append(os.path.join(self.root_dir,
+                                      folder,imgname))
+        return paths
+
+    def load_sample(self, idx, files):
+        # files are the paths from file_paths(idx), or file objects holding their bytes
         folder=idx+1
         folder=format(folder,'05d')
         clip=[]
         if len(self.labels)!=0:
             Label=self.labels[idx][0]-1
-        for i in range(3):
-            imidx=i+1
-            imgname=str(imidx)+'.jpg'
-            img_path = os.path.join(self.root_dir,
-                                    folder,imgname)
-            image = Image.open(img_path)
+        for f in files:
+            image = Image.open(f)
             image=np.array(image)
             clip.append(image)
-        if self.transform:
-            clip=np.asarray(clip)
-            clip=np.transpose(clip, (0,3,1,2))
-            clip = torch.from_numpy(np.asarray(clip))
+        clip=make_clip(clip, self.transform)
         if len(self.labels)!=0:
-            sample={'clip':clip,'Label':Label,'folder':folder}
+            sample={'clip':clip,'Label':Label,'folder':folder,'idx':idx}
         else:
-            sample={'clip':clip,'folder':folder}
+            sample={'clip':clip,'folder':folder,'idx':idx}
         return sample
 
 clip_dataset=ActionClipDataset(root_dir='../input/cse512f18hw6vid/data/data/trainClips/',                               labels=label_train,transform=T.ToTensor())#/home/tqvinh/Study/CSE512/cse512-s18/hw2data/trainClips/
@@ -820,9 +1024,10 @@ fixed_model_3d = nn.Sequential( # You fill this in!
     nn.BatchNorm3d(128),
     nn.ReLU(inplace=True),
     nn.MaxPool3d(kernel_size=2, stride=2),
+    nn.AdaptiveAvgPool3d((1, None, None)), # average over time, so clips of any length fit the Linear layer
     Flatten3d(),
     nn.ReLU(inplace=True),
-    nn.Linear(20736, 10),   
+    nn.Linear(10368, 10),   
     
 )
 
@@ -831,6 +1036,7 @@ x = torch.randn(32,3, 3, 64, 64).type(dtype)
 x_var = Variable(x).type(dtype) # Construct a PyTorch Variable out of your input data
 ans = fixed_model_3d(x_var) 
 np.array_equal(np.array(ans.size()), np.array([32, 10]))
+np.array_equal(np.array(fixed_model_3d(Variable(torch.randn(4, 3, 7, 64, 64).type(dtype))).size()), np.array([4, 10]))
 
 
 # ### Describe what you did (5 points)
@@ -851,6 +1057,7 @@ np.array_equal(np.array(ans.size()), np.array([32, 10]))
 # * Batch Normalization Layer
 # * ReLU Layer
 # * MaxPooling Layer of Size 2 with stride 2
+# * Temporal average pooling layer
 # * Flatten 
 # * ReLU Layer
 # * Affine layer
@@ -865,46 +1072,20 @@ optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
 # In[64]:
 
 
-def train_3d(model, loss_fn, optimizer,dataloader,num_epochs = 1):
-    for epoch in range(num_epochs):
-        print('Starting epoch %d / %d' % (epoch + 1, num_epochs))
-        model.train()
-        for t, sample in enumerate(dataloader):
-            x_var = Variable(sample['clip'].type(dtype))
-            y_var = Variable(sample['Label'].type(dtype).long())
-
-            scores = model(x_var)
-            
-            loss = loss_fn(scores, y_var)
-            if (t + 1) % print_every == 0:
-                print('t = %d, loss = %.4f' % (t + 1, loss.data[0]))
+def clip_batch(sample):
+    return Variable(clip_preprocess(sample['clip'])), Variable(sample['Label'].long())
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+def train_3d(model, loss_fn, optimizer,dataloader,num_epochs = 1, **kwargs):
+    return train_loop(model, loss_fn, optimizer, dataloader, clip_batch, num_epochs, **kwargs)
 
-def check_accuracy_3d(model, loader):
+def check_accuracy_3d(model, loader, metrics=None):
     '''
     if loader.dataset.train:
         print('Checking accuracy on validation set')
     else:
         print('Checking accuracy on test set')  
     '''
-    num_correct = 0
-    num_samples = 0
-    model.eval() # Put the model in test mode (the opposite of model.train(), essentially)
-    for t, sample in enumerate(loader):
-        x_var = Variable(sample['clip'].type(dtype))
-        y_var = sample['Label'].type(dtype)
-        y_var=y_var.cpu()
-        scores = model(x_var)
-        _, preds = scores.data.cpu().max(1)
-        #print(preds)
-        #print(y_var)
-        num_correct += (preds.numpy() == y_var.numpy()).sum()
-        num_samples += preds.size(0)
-    acc = float(num_correct) / num_samples
-    print('Got %d / %d correct (%.2f)' % (num_correct, num_samples, 100 * acc))
+    return evaluate(model, loader, clip_batch, metrics)
     
     
     #GPU Code
@@ -1016,7 +1197,7 @@ def predict_on_test_3d(model, loader):
     count=0
     results.write('Id'+','+'Class'+'\n')
     for t, sample in enumerate(loader):
-        x_var = Variable(sample['clip'].type(dtype))
+        x_var = Variable(clip_preprocess(sample['clip']))
         scores = model(x_var)
         _, preds = scores.data.max(1)
         for i in range(len(preds)):
@@ -1028,3 +1209,2338 @@ def predict_on_test_3d(model, loader):
 count=predict_on_test_3d(fixed_model_3d, clip_dataloader_test)
 print(count)
 
+
+# ### Structured channel pruning
+# 
+# The convolution stacks above are wide for a 10-class 64x64 problem: fixed_model_base carries 128/128/256/256 channels and fixed_model_3d goes up to 128. Zeroing individual weights does not make anything faster on the CPU, so instead we rank the output channels of every convolution and physically remove the weakest ones, together with the matching BatchNorm entries, the input channels of the next convolution and the matching columns of the final Linear layer. The result is an ordinary, smaller nn.Sequential that we fine-tune for a short while.
+# 
+# Channels are ranked by the absolute BatchNorm scale when the convolution is followed by a BatchNorm layer (method='bn'), and by the L1 norm of the filter otherwise (method='l1').
+
+# In[ ]:
+
+
+import io
+
+conv_types = (nn.Conv2d, nn.Conv3d)
+bn_types = (nn.BatchNorm2d, nn.BatchNorm3d)
+
+def channel_importance(conv, bn=None, method='bn'):
+    '''
+    Score every output channel of conv, higher means more important.
+    '''
+    if method == 'bn' and bn is not None and bn.affine:
+        return bn.weight.data.abs().cpu()
+    return conv.weight.data.abs().view(conv.out_channels, -1).sum(1).cpu()
+
+def slice_conv(conv, out_keep, in_keep):
+    new_conv = conv.__class__(len(in_keep), len(out_keep), conv.kernel_size,
+                              stride=conv.stride, padding=conv.padding,
+                              dilation=conv.dilation, bias=conv.bias is not None)
+    new_conv.weight.data = conv.weight.data[out_keep][:, in_keep].clone()
+    if conv.bias is not None:
+        new_conv.bias.data = conv.bias.data[out_keep].clone()
+    return new_conv
+
+def slice_bn(bn, keep):
+    new_bn = bn.__class__(len(keep), eps=bn.eps, momentum=bn.momentum, affine=bn.affine)
+    if bn.affine:
+        new_bn.weight.data = bn.weight.data[keep].clone()
+        new_bn.bias.data = bn.bias.data[keep].clone()
+    new_bn.running_mean = bn.running_mean[keep].clone()
+    new_bn.running_var = bn.running_var[keep].clone()
+    return new_bn
+
+def slice_linear(linear, in_keep):
+    new_linear = nn.Linear(len(in_keep), linear.out_features, bias=linear.bias is not None)
+    new_linear.weight.data = linear.weight.data[:, in_keep].clone()
+    if linear.bias is not None:
+        new_linear.bias.data = linear.bias.data.clone()
+    return new_linear
+
+def prune_channels(model, example_input, amount=0.5, method='bn', min_channels=8):
+    '''
+    Return a pruned copy of the nn.Sequential model in which every convolution keeps
+    only the (1 - amount) fraction of its output channels with the highest importance.
+    example_input is a batch in the layout the model expects. It is only used to find
+    the size of the feature map that gets flattened in front of the Linear layer.
+    '''
+    model = copy.deepcopy(model).cpu()
+    was_training = model.training
+    model.eval()
+    layers = list(model)
+
+    # Run the layers one by one to record the shape each of them receives.
+    shapes = []
+    x = example_input[:1].cpu().float()
+    with torch.no_grad():
+        for layer in layers:
+            shapes.append(x.size())
+            x = layer(x)
+
+    keep = None        # indices of the channels that survive at the current point of the stack
+    flat_size = None   # number of values per channel once the feature map is flattened
+    for i, layer in enumerate(layers):
+        if isinstance(layer, conv_types):
+            assert layer.groups == 1, 'grouped convolutions are not supported'
+            in_keep = keep if keep is not None else torch.arange(layer.in_channels).long()
+            bn = None
+            for nxt in layers[i + 1:]:
+                if isinstance(nxt, bn_types):
+                    bn = nxt
+                    break
+                if isinstance(nxt, conv_types + (nn.Linear,)):
+                    break
+            scores = channel_importance(layer, bn, method)
+            n_keep = max(min(min_channels, layer.out_channels), int(round(layer.out_channels * (1 - amount))))
+            keep = scores.topk(n_keep)[1].sort()[0]
+            layers[i] = slice_conv(layer, keep, in_keep)
+        elif isinstance(layer, bn_types) and keep is not None:
+            layers[i] = slice_bn(layer, keep)
+        elif isinstance(layer, nn.Linear):
+            if keep is not None and flat_size is not None:
+                in_keep = (keep.view(-1, 1) * flat_size + torch.arange(flat_size).long().view(1, -1)).view(-1)
+                layers[i] = slice_linear(layer, in_keep)
+            keep = None
+        elif len(shapes[i]) > 2 and i + 1 < len(shapes) and len(shapes[i + 1]) == 2:
+            # this layer flattens C x (spatial) into one vector
+            flat_size = int(np.prod(shapes[i][2:]))
+
+    pruned = nn.Sequential(*layers)
+    pruned.train(was_training)
+    return pruned
+
+def cpu_latency(model, example_input, repeats=20):
+    '''
+    Average wall-clock seconds of one forward pass of example_input on the CPU.
+    '''
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    x = example_input.cpu().float()
+    with torch.no_grad():
+        model(x) # warm up
+        total = timeit.timeit(lambda: model(x), number=repeats)
+    return total / repeats
+
+def model_size(model):
+    '''
+    Size in bytes of the serialized state_dict.
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def pruning_report(model, pruned, example_input, repeats=20):
+    before = (sum(p.numel() for p in model.parameters()), model_size(model), cpu_latency(model, example_input, repeats))
+    after = (sum(p.numel() for p in pruned.parameters()), model_size(pruned), cpu_latency(pruned, example_input, repeats))
+    print('%-12s %14s %14s' % ('', 'original', 'pruned'))
+    print('%-12s %14d %14d' % ('parameters', before[0], after[0]))
+    print('%-12s %14.2f %14.2f' % ('size (MB)', before[1] / 2.0**20, after[1] / 2.0**20))
+    print('%-12s %14.2f %14.2f' % ('latency (ms)', 1000 * before[2], 1000 * after[2]))
+    print('CPU speedup %.2fx, %.1f%% smaller' % (before[2] / after[2], 100 * (1 - float(after[1]) / before[1])))
+    return before, after
+
+def prune_and_finetune(model, example_input, train_fn, loss_fn, dataloader,
+                       amount=0.5, method='bn', num_epochs=1, lr=1e-4):
+    '''
+    Prune a copy of model, fine-tune it with train_fn (train or train_3d) and
+    report the CPU latency and size of both models. The original model is untouched.
+    '''
+    pruned = prune_channels(model, example_input, amount=amount, method=method)
+    pruned.to(next(model.parameters()).device)
+    optimizer = optim.RMSprop(pruned.parameters(), lr=lr)
+    train_fn(pruned, loss_fn, optimizer, dataloader, num_epochs=num_epochs)
+    pruning_report(model, pruned, example_input)
+    return pruned
+
+
+# Prune half of the channels of the 2D and 3D models, fine-tune for one epoch and compare.
+
+# In[ ]:
+
+
+pruned_model_base = prune_and_finetune(fixed_model_gpu, torch.randn(32, 3, 64, 64), train, nn.CrossEntropyLoss(),
+                                       image_dataloader_train, amount=0.5, num_epochs=1)
+check_accuracy(pruned_model_base, image_dataloader_val)
+
+pruned_model_3d = prune_and_finetune(fixed_model_3d, torch.randn(16, 3, 3, 64, 64), train_3d, nn.CrossEntropyLoss(),
+                                     clip_dataloader_train, amount=0.5, num_epochs=1)
+check_accuracy_3d(pruned_model_3d, clip_dataloader_val)
+
+
+# ### Knowledge distillation
+# 
+# fixed_model_base and fixed_model_3d give our best accuracy but are expensive to run. Here a small student network is trained to match the softened output distribution of a frozen teacher, in addition to the true labels:
+# 
+#     loss = alpha * T^2 * KL(softmax(teacher / T) || softmax(student / T)) + (1 - alpha) * CrossEntropy(student, label)
+# 
+# The teacher never changes, so its scores can be cached on disk with TeacherLogitCache: they are computed the first time a sample is seen and read back in every later epoch. The cache is keyed by the 'idx' of each sample, and it stores a fingerprint of the teacher's weights: when the teacher has been retrained since, the old scores are discarded. Both models above end in LogSoftmax or raw scores; the softmax is shift invariant, so either works as teacher or student.
+
+# In[ ]:
+
+
+import hashlib
+
+class DistillationLoss(nn.Module):
+    """Temperature-scaled KL to the teacher plus cross-entropy to the labels."""
+
+    def __init__(self, temperature=4.0, alpha=0.9, hard_loss_fn=None, reduction='mean'):
+        """
+        Args:
+            temperature (float): softening temperature T applied to both score vectors.
+            alpha (float): weight of the distillation term, 1 - alpha goes to the label loss.
+            hard_loss_fn (callable, optional): loss on the true labels, nn.CrossEntropyLoss() by default.
+                It needs a reduction attribute for reduction='none'.
+            reduction (string): 'mean', 'sum' or 'none' (one loss per sample).
+        """
+        super(DistillationLoss, self).__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+        self.hard_loss_fn = hard_loss_fn if hard_loss_fn is not None else nn.CrossEntropyLoss()
+        self.reduction = reduction
+
+    def forward(self, scores, target):
+        # target is the (labels, teacher_scores) pair built by train_distill
+        y_var, teacher_scores = target
+        T = self.temperature
+        soft_loss = nn.functional.kl_div(nn.functional.log_softmax(scores / T, dim=1),
+                                         nn.functional.softmax(teacher_scores / T, dim=1),
+                                         reduction='none').sum(1) * T * T
+        losses = self.alpha * soft_loss + (1 - self.alpha) * per_sample_losses(self.hard_loss_fn, scores, y_var)
+        if self.reduction == 'none':
+            return losses
+        return losses.sum() if self.reduction == 'sum' else losses.mean()
+
+
+def model_fingerprint(model):
+    '''
+    SHA-1 of the names, shapes and values of the state_dict of model.
+    '''
+    digest = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        digest.update(name.encode())
+        if torch.is_tensor(value):
+            value = value.detach().cpu().contiguous()
+            digest.update(str(tuple(value.size())).encode())
+            digest.update(value.numpy().tobytes())
+    return digest.hexdigest()
+
+def grow_npy(path, num_rows):
+    '''
+    Grow the first dimension of the .npy file at path to num_rows; the new rows are zero.
+    numpy leaves room in the header for this, so normally only the header is rewritten and
+    the file is extended, without copying the existing rows.
+    '''
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            read_header, write_header = np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0
+        else:
+            read_header, write_header = np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        assert not fortran_order, 'only C-ordered arrays can grow'
+        if num_rows <= shape[0]:
+            return
+        header_len = f.tell()
+        header = io.BytesIO()
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (num_rows,) + tuple(shape[1:])})
+        if len(header.getvalue()) == header_len:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.truncate(header_len + num_rows * dtype.itemsize * int(np.prod(shape[1:])))
+            return
+    # the new header does not fit, copy into a new file
+    old = np.load(path, mmap_mode='r')
+    new = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=(num_rows,) + tuple(shape[1:]))
+    new[:len(old)] = old
+    new.flush()
+    del old, new
+    os.rename(path + '.tmp', path)
+
+
+class TeacherLogitCache(object):
+    """Teacher scores for every sample of a dataset, stored in .npy files on disk."""
+
+    def __init__(self, path, num_samples, num_classes=10, teacher=None):
+        """
+        Args:
+            path (string): prefix of the cache files, path+'_scores.npy' and path+'_filled.npy'.
+            num_samples (int): length of the dataset the cache is keyed on.
+            num_classes (int): number of scores per sample.
+            teacher (nn.Module, optional): the model the scores come from. Its fingerprint is
+                stored in path+'_teacher.txt', and cached scores of different weights are discarded.
+        """
+        scores_path, filled_path = path + '_scores.npy', path + '_filled.npy'
+        self.teacher_path = path + '_teacher.txt'
+        if os.path.exists(scores_path) and os.path.exists(filled_path):
+            # a dataset that grew keeps the scores of its old samples
+            grow_npy(scores_path, num_samples)
+            grow_npy(filled_path, num_samples)
+            self.scores = np.load(scores_path, mmap_mode='r+')
+            self.filled = np.load(filled_path, mmap_mode='r+')
+            if self.scores.shape != (num_samples, num_classes):
+                raise ValueError('cache %s has shape %s, expected %s'
+                                 % (scores_path, self.scores.shape, (num_samples, num_classes)))
+        else:
+            self.scores = np.lib.format.open_memmap(scores_path, mode='w+', dtype=np.float32,
+                                                    shape=(num_samples, num_classes))
+            self.filled = np.lib.format.open_memmap(filled_path, mode='w+', dtype=np.bool_,
+                                                    shape=(num_samples,))
+        if teacher is not None:
+            self.check_teacher(teacher)
+
+    def check_teacher(self, teacher):
+        '''
+        Clear the cache unless it was filled by a teacher with exactly the weights of teacher.
+        '''
+        fingerprint = model_fingerprint(teacher)
+        stored = None
+        if os.path.exists(self.teacher_path):
+            with open(self.teacher_path) as f:
+                stored = f.read().strip()
+        if stored != fingerprint:
+            if stored is not None and self.filled.any():
+                print('Teacher weights changed, clearing %s' % self.teacher_path[:-len('_teacher.txt')])
+            self.filled[:] = False
+            self.filled.flush()
+            with open(self.teacher_path + '.tmp', 'w') as f:
+                f.write(fingerprint + '\n')
+            os.replace(self.teacher_path + '.tmp', self.teacher_path)
+
+    def lookup(self, teacher, x_var, idx):
+        '''
+        Return the teacher scores for the batch x_var whose dataset indices are idx,
+        running the teacher only on the samples that are not cached yet.
+        '''
+        idx = idx.numpy()
+        missing = np.nonzero(~self.filled[idx])[0]
+        if len(missing) > 0:
+            with torch.no_grad():
+                scores = teacher(x_var[torch.from_numpy(missing).to(x_var.device)])
+            self.scores[idx[missing]] = scores.data.cpu().numpy()
+            self.filled[idx[missing]] = True
+        return torch.from_numpy(np.array(self.scores[idx])).to(x_var.device)
+
+    def flush(self):
+        self.scores.flush()
+        self.filled.flush()
+
+
+def train_distill(teacher, student, loss_fn, optimizer, dataloader, get_batch, num_epochs = 1, cache=None, **kwargs):
+    '''
+    Train student on dataloader with loss_fn (a DistillationLoss) against the frozen teacher.
+    get_batch is image_batch for 2D models and clip_batch for 3D models, exactly as for train_loop.
+    kwargs (e.g. sampler) are passed on to train_loop.
+    The teacher only runs under no_grad, so its parameters are left trainable for later cells.
+    '''
+    teacher.eval()
+
+    def distill_batch(sample):
+        x_var, y_var = get_batch(sample)
+        if cache is not None:
+            teacher_scores = cache.lookup(teacher, x_var, sample['idx'])
+        else:
+            with torch.no_grad():
+                teacher_scores = teacher(x_var)
+        return x_var, (y_var, teacher_scores)
+
+    train_loop(student, loss_fn, optimizer, dataloader, distill_batch, num_epochs, **kwargs)
+    if cache is not None:
+        cache.flush()
+
+
+# Small students for the two teachers: two narrow conv blocks instead of four wide ones for the images, and 8/16 instead of 32/64/128 channels for the clips.
+
+# In[ ]:
+
+
+student_model_base = nn.Sequential(
+    nn.Conv2d(3,16,kernel_size=3,stride=1),
+    nn.ReLU(inplace=True),
+    nn.BatchNorm2d(16),
+    nn.MaxPool2d(2, stride = 2),
+
+    nn.Conv2d(16,32,kernel_size=3,stride=1),
+    nn.ReLU(inplace=True),
+    nn.BatchNorm2d(32),
+    nn.MaxPool2d(2, stride = 2),
+
+    Flatten(),
+    nn.Linear(6272,10)
+).type(dtype)
+
+student_model_3d = nn.Sequential(
+    nn.Conv3d(3, 8, kernel_size=3, stride=1, padding=2),
+    nn.BatchNorm3d(8),
+    nn.ReLU(inplace=True),
+    nn.MaxPool3d(kernel_size=2, stride=2),
+
+    nn.Conv3d(8, 16, kernel_size=3, stride=1, padding=2),
+    nn.BatchNorm3d(16),
+    nn.ReLU(inplace=True),
+    nn.MaxPool3d(kernel_size=2, stride=2),
+    nn.AdaptiveAvgPool3d((1, None, None)),
+    Flatten3d(),
+    nn.Linear(4624, 10),
+).type(dtype)
+
+
+# Distill fixed_model into student_model_base and fixed_model_3d into student_model_3d. The teacher scores are computed during the first epoch only. The students are ordinary nn.Sequential models, so they go through the same predict_on_test / predict_on_test_3d path as their teachers.
+
+# In[ ]:
+
+
+torch.random.manual_seed(12345)
+student_model_base.apply(reset)
+optimizer = optim.Adam(student_model_base.parameters(), lr=1e-3)
+teacher_cache = TeacherLogitCache('teacher_base_train', len(image_dataset_train), teacher=fixed_model)
+train_distill(fixed_model, student_model_base, DistillationLoss(temperature=4.0, alpha=0.9), optimizer,
+              image_dataloader_train, image_batch, num_epochs=3, cache=teacher_cache)
+evaluate(student_model_base, image_dataloader_val, image_batch)
+
+student_model_3d.apply(reset)
+optimizer = optim.Adam(student_model_3d.parameters(), lr=1e-3)
+teacher_cache_3d = TeacherLogitCache('teacher_3d_train', len(clip_dataset_train), teacher=fixed_model_3d)
+train_distill(fixed_model_3d, student_model_3d, DistillationLoss(temperature=4.0, alpha=0.9), optimizer,
+              clip_dataloader_train, clip_batch, num_epochs=3, cache=teacher_cache_3d)
+check_accuracy_3d(student_model_3d, clip_dataloader_val)
+
+count=predict_on_test(student_model_base, image_dataloader_test)
+count=predict_on_test_3d(student_model_3d, clip_dataloader_test)
+print(count)
+
+
+# ### Loss-driven importance sampling
+# 
+# With shuffle=True every epoch spends the same compute on clips the model already gets right. LossImportanceSampler keeps a running loss for every sample and draws samples with probability
+# 
+#     p_i  ~  (loss_i + eps)^alpha * class_weight[label_i],   class_weight[c] = (N / (K * count_c))^beta
+# 
+# mixed with a uniform distribution (uniform_mix) so that no sample is starved. train_loop multiplies each sample's loss by 1 / (N * p_i), which keeps the expected gradient equal to the one of uniform sampling. The losses come for free from the forward pass train_loop already does. Unseen samples start at log(K), the loss of a uniform guess.
+# 
+# The running losses, labels, visit counts and the probabilities of the current epoch live in one structured numpy array of 14 bytes per sample; the only other state is the order of the current epoch, 4 bytes per drawn sample.
+
+# In[ ]:
+
+
+class LossImportanceSampler(sampler.Sampler):
+    """Samples hard and rare-class examples more often, with importance weights."""
+
+    table_dtype = np.dtype([('loss', np.float32), ('label', np.int16), ('seen', np.uint32), ('prob', np.float32)])
+
+    def __init__(self, labels, num_samples=None, alpha=1.0, beta=0.5, uniform_mix=0.2, decay=0.9, seed=0):
+        """
+        Args:
+            labels (array): 0-based class of every sample of the dataset.
+            num_samples (int, optional): samples drawn per epoch, len(labels) by default.
+            alpha (float): how strongly the running loss drives the sampling, 0 ignores it.
+            beta (float): how strongly rare classes are boosted, 0 ignores class frequency.
+            uniform_mix (float): share of the uniform distribution in the mix, bounds the weights by 1 / uniform_mix.
+            decay (float): decay of the running loss of each sample.
+            seed (int): seed of the sampling random state.
+        """
+        labels = np.asarray(labels).reshape(-1)
+        self.num_classes = int(labels.max()) + 1
+        self.table = np.zeros(len(labels), dtype=self.table_dtype)
+        self.table['loss'] = np.log(self.num_classes)
+        self.table['label'] = labels
+        self.table['prob'] = 1.0 / len(labels)
+        self.num_samples = num_samples if num_samples is not None else len(labels)
+        self.alpha = alpha
+        self.beta = beta
+        self.uniform_mix = uniform_mix
+        self.decay = decay
+        self.rng = np.random.RandomState(seed)
+        self.epoch_order = None
+        self.start = 0
+        self.resuming = False
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def sampling_probs(self):
+        N = len(self.table)
+        counts = np.bincount(self.table['label'], minlength=self.num_classes).astype(np.float64)
+        class_weight = (N / (self.num_classes * np.maximum(counts, 1))) ** self.beta
+        probs = (self.table['loss'].astype(np.float64) + 1e-3) ** self.alpha * class_weight[self.table['label']]
+        probs /= probs.sum()
+        return (1 - self.uniform_mix) * probs + self.uniform_mix / N
+
+    def __iter__(self):
+        # probabilities are frozen for the epoch so the weights match the distribution actually sampled
+        if not self.resuming:
+            probs = self.sampling_probs()
+            self.table['prob'] = probs
+            self.epoch_order = self.rng.choice(len(self.table), size=self.num_samples, replace=True,
+                                               p=probs).astype(np.uint32)
+        start = self.start
+        self.resuming, self.start = False, 0
+        return iter(self.epoch_order[start:].tolist())
+
+    def skip(self, num_samples):
+        self.start = num_samples
+
+    def state_dict(self):
+        return {'table': self.table.copy(), 'rng': self.rng.get_state(),
+                'epoch_order': None if self.epoch_order is None else self.epoch_order.copy()}
+
+    def load_state_dict(self, state):
+        # the next __iter__ replays the interrupted epoch instead of drawing a new one
+        self.table[:] = state['table']
+        self.rng.set_state(state['rng'])
+        self.epoch_order = state['epoch_order']
+        self.resuming = self.epoch_order is not None
+
+    def weights(self, idx):
+        idx = np.asarray(idx)
+        return torch.from_numpy((1.0 / (len(self.table) * self.table['prob'][idx])).astype(np.float32))
+
+    def update(self, idx, losses):
+        idx = np.asarray(idx)
+        losses = losses.cpu().numpy()
+        seen = self.table['seen'][idx] > 0
+        self.table['loss'][idx] = np.where(seen, self.decay * self.table['loss'][idx] + (1 - self.decay) * losses, losses)
+        self.table['seen'][idx] += 1
+
+
+def time_to_accuracy(model, loss_fn, optimizer, dataloader, val_loader, get_batch, target_acc,
+                     max_epochs=10, sampler=None, **kwargs):
+    '''
+    Train one epoch at a time until the validation accuracy reaches target_acc.
+    Returns (training seconds, epochs), or (None, max_epochs) if the target was not reached.
+    Validation time is not counted. kwargs are passed on to train_loop.
+    '''
+    train_time = 0.0
+    for epoch in range(max_epochs):
+        start = timeit.default_timer()
+        train_loop(model, loss_fn, optimizer, dataloader, get_batch, 1, sampler=sampler, **kwargs)
+        train_time += timeit.default_timer() - start
+        if evaluate(model, val_loader, get_batch) >= target_acc:
+            return train_time, epoch + 1
+    return None, max_epochs
+
+
+# Compare the time to reach the same validation accuracy with uniform shuffling and with the importance sampler, starting from the same initialization of fixed_model_3d.
+
+# In[ ]:
+
+
+clip_sampler_train = LossImportanceSampler(label_train[:, 0] - 1)
+clip_dataloader_importance = DataLoader(clip_dataset_train, batch_size=16,
+                        sampler=clip_sampler_train, num_workers=4)
+
+target_acc = 0.5
+results = {}
+torch.random.manual_seed(12345)
+fixed_model_3d.apply(reset)
+initial_state = copy.deepcopy(fixed_model_3d.state_dict())
+for name, loader, clip_sampler in [('uniform', clip_dataloader_train, None),
+                                   ('importance', clip_dataloader_importance, clip_sampler_train)]:
+    fixed_model_3d.load_state_dict(initial_state)
+    optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+    results[name] = time_to_accuracy(fixed_model_3d, loss_fn, optimizer, loader, clip_dataloader_val,
+                                     clip_batch, target_acc, max_epochs=10, sampler=clip_sampler)
+for name in results:
+    seconds, epochs = results[name]
+    if seconds is None:
+        print('%-10s did not reach %.2f in %d epochs' % (name, target_acc, epochs))
+    else:
+        print('%-10s reached %.2f in %d epochs, %.1f s' % (name, target_acc, epochs, seconds))
+
+
+# ### Checkpointing and resumable training
+# 
+# A crash in the middle of a long run used to lose everything. AsyncCheckpointer writes a checkpoint every `every` optimizer steps with the model, the optimizer, the position of the sampler, the running statistics and the state of every random number generator. The training loop only takes a snapshot (a copy of the tensors to CPU memory); serialization, fsync and the rotation of old checkpoints happen on a background thread, so the loop does not stall on the disk.
+# 
+# With checkpointer=... train / train_3d resume from the newest checkpoint: same weights, same optimizer state, same data order and the same next step. For the data order to be reproducible the dataloader needs a sampler that can be restored; ResumableRandomSampler replaces shuffle=True for that, and LossImportanceSampler supports it as well.
+
+# In[ ]:
+
+
+import glob
+import queue
+import random
+import threading
+
+class ResumableSampler(sampler.Sampler):
+    """Base of the samplers whose order is determined by (seed, epoch) and that can start mid-epoch."""
+
+    def __init__(self, seed=0):
+        """
+        Args:
+            seed (int): base seed, the order of epoch e is drawn with seed + e.
+        """
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, num_items):
+        # the next epoch starts at item num_items of its order
+        self.start = num_items
+
+    def generator(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return generator
+
+    def order(self):
+        '''
+        The items (indices or batches) of the current epoch, in order.
+        '''
+        raise NotImplementedError
+
+    def __iter__(self):
+        order = self.order()
+        start, self.start = self.start, 0
+        return iter(order[start:])
+
+    def __len__(self):
+        return len(self.order()) - self.start
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+
+
+class ResumableRandomSampler(ResumableSampler):
+    """Random permutation per epoch that is determined by (seed, epoch) and can start mid-epoch."""
+
+    def __init__(self, data_source, seed=0):
+        """
+        Args:
+            data_source (Dataset): dataset to sample from.
+            seed (int): base seed, the permutation of epoch e is drawn with seed + e.
+        """
+        super(ResumableRandomSampler, self).__init__(seed)
+        self.num_samples = len(data_source)
+
+    def order(self):
+        return torch.randperm(self.num_samples, generator=self.generator()).tolist()
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def training_state(model, optimizer, data_sampler, step, epoch, batches_done, running, val_acc, scheduler=None):
+    return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'sampler': data_sampler.state_dict() if hasattr(data_sampler, 'state_dict') else None,
+            'step': step, 'epoch': epoch, 'batches_done': batches_done,
+            'running': running, 'val_acc': list(val_acc), 'rng': rng_state()}
+
+def restore_checkpoint(checkpoint, model, optimizer, data_sampler, scheduler=None):
+    '''
+    Load a checkpoint written by train_loop. Returns (step, epoch, batches done in that epoch).
+    '''
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None and checkpoint.get('scheduler') is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    if checkpoint['sampler'] is not None and hasattr(data_sampler, 'load_state_dict'):
+        data_sampler.load_state_dict(checkpoint['sampler'])
+    elif not (hasattr(data_sampler, 'skip') or hasattr(data_sampler, 'skip_batches')):
+        print('Warning: %s cannot be restored, the data order after resuming will differ'
+              % data_sampler.__class__.__name__)
+    running = checkpoint['running']
+    if running is not None:
+        device = next(model.parameters()).device
+        checkpoint['running'] = tuple(r.to(device) if torch.is_tensor(r) else r for r in running)
+    set_rng_state(checkpoint['rng'])
+    return checkpoint['step'], checkpoint['epoch'], checkpoint['batches_done']
+
+def snapshot(obj):
+    '''
+    Copy of a (nested) training state that the training loop can no longer modify:
+    tensors are cloned to CPU memory, numpy arrays copied.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return obj.__class__((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointer(object):
+    """Writes training checkpoints from a background thread and keeps the newest few."""
+
+    def __init__(self, directory, every=500, keep=3):
+        """
+        Args:
+            directory (string): where checkpoint_<step>.pt files are written.
+            every (int): checkpoint every that many optimizer steps.
+            keep (int): number of checkpoints kept on disk, older ones are deleted.
+        """
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # one snapshot in flight at most: if the disk cannot keep up, save() waits instead of piling up copies
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def due(self, step):
+        return self.every > 0 and step % self.every == 0
+
+    def save(self, step, state):
+        self._raise_error()
+        self.pending.put((step, snapshot(state)))
+
+    def wait(self):
+        '''
+        Block until every checkpoint handed to save() is on disk.
+        '''
+        self.pending.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.pending.put(None)
+        self.writer.join()
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'checkpoint_*.pt')))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def load_latest(self):
+        path = self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            step, state = item
+            try:
+                self._write(step, state)
+            except Exception as e:
+                self.error = e
+            self.pending.task_done()
+
+    def _write(self, step, state):
+        path = os.path.join(self.directory, 'checkpoint_%09d.pt' % step)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # the rename is atomic, a crash leaves either the old or the new checkpoint, never half of one
+        os.rename(tmp_path, path)
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for old_path in self.checkpoints()[:-self.keep]:
+            os.remove(old_path)
+
+
+# Train fixed_model_3d with a checkpoint every 200 steps. If the run is interrupted, re-running this cell continues from the newest checkpoint instead of starting from scratch.
+
+# In[ ]:
+
+
+clip_dataloader_resumable = DataLoader(clip_dataset_train, batch_size=16,
+                        sampler=ResumableRandomSampler(clip_dataset_train, seed=12345), num_workers=4)
+checkpointer = AsyncCheckpointer('checkpoints_3d', every=200, keep=3)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+if checkpointer.latest() is None:
+    torch.random.manual_seed(12345)
+    fixed_model_3d.apply(reset)
+train_stats = train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_resumable, num_epochs=3,
+                       checkpointer=checkpointer)
+check_accuracy_3d(fixed_model_3d, clip_dataloader_val)
+
+
+# ### Sharded clip records for streaming
+# 
+# Opening trainClips/<05d>/<k>.jpg one file at a time is the worst access pattern for network and object storage. write_shards packs the clips into a few large shard files that are read sequentially, start to end:
+# 
+# * shard-<05d>.rec: the JPEG bytes of all frames of all clips of the shard, back to back.
+# * shard-<05d>.idx.npz: the offset index, 'clips' (clip number, label, offset of the first frame, number of frames, position of the first frame in 'frame_sizes') and 'frame_sizes' (bytes of every frame).
+# * manifest.json: the shards in order with their number of clips and bytes.
+# 
+# ShardedClipDataset is an IterableDataset that reads one whole shard at a time, shuffles clips within a buffer and splits the shards deterministically across nodes (rank / world_size, taken from torch.distributed when it is initialized) and across DataLoader workers. Every epoch the shard order is reshuffled with seed + epoch, identically on every node. It yields the same samples as ActionClipDataset, so it works with train_3d and check_accuracy_3d. The shards are the unit of parallelism: use at least as many shards as nodes times workers.
+
+# In[ ]:
+
+
+import json
+
+shard_index_dtype = np.dtype([('clip', np.int32), ('label', np.int16), ('offset', np.int64),
+                              ('nframes', np.int16), ('first_frame', np.int64)])
+
+def clip_frame_paths(clip_dir):
+    '''
+    Frame files of a clip directory in frame order, 1.jpg, 2.jpg, ...
+    '''
+    names = [name for name in os.listdir(clip_dir) if name.endswith('.jpg')]
+    names.sort(key=lambda name: int(os.path.splitext(name)[0]))
+    return [os.path.join(clip_dir, name) for name in names]
+
+def read_manifest(shard_dir):
+    path = os.path.join(shard_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {'shards': []}
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(shard_dir, manifest):
+    tmp_path = os.path.join(shard_dir, 'manifest.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(tmp_path, os.path.join(shard_dir, 'manifest.json'))
+
+def write_shards(root_dir, shard_dir, labels=[], clips=None, shard_bytes=64 * 2**20):
+    '''
+    Pack the clip directories of root_dir into shards of about shard_bytes in shard_dir.
+    labels are the 1-based labels of hw6_data.mat (empty for the test set); clips
+    optionally restricts the conversion to these 1-based clip numbers. New shards are
+    appended after the ones already listed in the manifest of shard_dir.
+    '''
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    manifest = read_manifest(shard_dir)
+    if clips is None:
+        clips = sorted(int(folder) for folder in os.listdir(root_dir))
+
+    def flush(records, frame_sizes, data):
+        name = 'shard-%05d' % len(manifest['shards'])
+        with open(os.path.join(shard_dir, name + '.rec'), 'wb') as f:
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        np.savez(os.path.join(shard_dir, name + '.idx.npz'),
+                 clips=np.array(records, dtype=shard_index_dtype),
+                 frame_sizes=np.array(frame_sizes, dtype=np.int32))
+        manifest['shards'].append({'name': name, 'clips': len(records), 'bytes': sum(frame_sizes)})
+        write_manifest(shard_dir, manifest)
+
+    records, frame_sizes, data = [], [], []
+    offset = 0
+    for clip in clips:
+        label = labels[clip - 1][0] - 1 if len(labels) != 0 else -1
+        frames = []
+        for path in clip_frame_paths(os.path.join(root_dir, format(clip, '05d'))):
+            with open(path, 'rb') as f:
+                frames.append(f.read())
+        records.append((clip, label, offset, len(frames), len(frame_sizes)))
+        frame_sizes.extend(len(frame) for frame in frames)
+        data.extend(frames)
+        offset += sum(len(frame) for frame in frames)
+        if offset >= shard_bytes:
+            flush(records, frame_sizes, data)
+            records, frame_sizes, data = [], [], []
+            offset = 0
+    if records:
+        flush(records, frame_sizes, data)
+    return manifest
+
+def convert_clips(root_dir, mat_path, label_key, shard_dir, shard_bytes=64 * 2**20, overwrite=False):
+    '''
+    Convert a clip directory and its labels in hw6_data.mat ('trLb', 'valLb', or None for the test set) to shards.
+    A shard_dir that already holds shards is left as it is, so the clips are never converted
+    twice; overwrite=True deletes its shards and converts again. Clips added later are appended
+    with write_shards(..., clips=...), as append_clips does.
+    '''
+    manifest = read_manifest(shard_dir)
+    if manifest['shards']:
+        if not overwrite:
+            print('%s already holds %d shards, not converting again (overwrite=True to redo)'
+                  % (shard_dir, len(manifest['shards'])))
+            return manifest
+        # the manifest goes first: without it, leftover shard files are never read
+        write_manifest(shard_dir, {'shards': []})
+        for shard in manifest['shards']:
+            for name in (shard['name'] + '.rec', shard['name'] + '.idx.npz'):
+                if os.path.exists(os.path.join(shard_dir, name)):
+                    os.remove(os.path.join(shard_dir, name))
+    labels = scipy.io.loadmat(mat_path)[label_key] if label_key else []
+    return write_shards(root_dir, shard_dir, labels, shard_bytes=shard_bytes)
+
+
+class ShardedClipDataset(torch.utils.data.IterableDataset):
+    """Streams the clips of a shard directory written by write_shards."""
+
+    def __init__(self, shard_dir, transform=None, shuffle_buffer=256, seed=0, rank=None, world_size=None, shards=None):
+        """
+        Args:
+            shard_dir (string): directory with manifest.json and the shards.
+            transform (callable, optional): same meaning as for ActionClipDataset.
+            shuffle_buffer (int): clips held in the shuffle buffer, 0 keeps the stored order.
+            seed (int): seed of the shard order and the buffer shuffling, combined with the epoch.
+            rank, world_size (int, optional): this node and the number of nodes.
+            shards (list, optional): names of the shards to read, all shards of the manifest by default.
+        """
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        if rank is None or world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        manifest = read_manifest(shard_dir)
+        self.shards = [shard for shard in manifest['shards'] if shards is None or shard['name'] in shards]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def node_shards(self):
+        shards = list(self.shards)
+        if self.shuffle_buffer:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.rank::self.world_size]
+
+    def __len__(self):
+        return sum(shard['clips'] for shard in self.node_shards())
+
+    def read_shard(self, name):
+        index = np.load(os.path.join(self.shard_dir, name + '.idx.npz'))
+        with open(os.path.join(self.shard_dir, name + '.rec'), 'rb') as f:
+            data = f.read() # one sequential read of the whole shard
+        frame_sizes = index['frame_sizes']
+        for record in index['clips']:
+            offset = int(record['offset'])
+            frames = []
+            for size in frame_sizes[record['first_frame']:record['first_frame'] + record['nframes']]:
+                frames.append(data[offset:offset + size])
+                offset += size
+            yield record, frames
+
+    def make_sample(self, record, frames):
+        clip = make_clip([np.array(Image.open(io.BytesIO(frame))) for frame in frames], self.transform)
+        folder = format(int(record['clip']), '05d')
+        sample = {'clip': clip, 'folder': folder, 'idx': int(record['clip']) - 1}
+        if record['label'] >= 0:
+            sample['Label'] = int(record['label'])
+        return sample
+
+    def __iter__(self):
+        shards = self.node_shards()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        shards = shards[worker_id::num_workers]
+        rng = random.Random((self.seed + self.epoch) * 1000003 + self.rank * 1009 + worker_id)
+        buffer = []
+        for shard in shards:
+            for record, frames in self.read_shard(shard['name']):
+                # only the JPEG bytes sit in the buffer, clips are decoded when they leave it
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((record, frames))
+                    continue
+                if self.shuffle_buffer:
+                    i = rng.randrange(len(buffer))
+                    buffer[i], (record, frames) = (record, frames), buffer[i]
+                yield self.make_sample(record, frames)
+        rng.shuffle(buffer)
+        for record, frames in buffer:
+            yield self.make_sample(record, frames)
+
+
+# Convert the three clip directories once, then stream the training set from the shards.
+
+# In[ ]:
+
+
+data_dir = '../input/cse512f18hw6vid/data/data/'
+label_path = '../input/dataset/hw6_data.mat'
+convert_clips(data_dir + 'trainClips', label_path, 'trLb', 'shards/train')
+convert_clips(data_dir + 'valClips', label_path, 'valLb', 'shards/val')
+convert_clips(data_dir + 'testClips', label_path, None, 'shards/test')
+
+clip_dataset_sharded = ShardedClipDataset('shards/train', transform=T.ToTensor(), shuffle_buffer=512, seed=12345)
+clip_dataloader_sharded = DataLoader(clip_dataset_sharded, batch_size=16, num_workers=4)
+clip_dataloader_sharded_val = DataLoader(ShardedClipDataset('shards/val', transform=T.ToTensor(), shuffle_buffer=0),
+                                         batch_size=16, num_workers=4)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_sharded, num_epochs=3)
+check_accuracy_3d(fixed_model_3d, clip_dataloader_sharded_val)
+
+
+# ### Readahead prefetching
+# 
+# ActionDataset and ActionClipDataset open their frames one after the other, and with num_workers=0 nothing else happens while a file is being read. On high-latency storage the CPU mostly waits. ReadaheadLoader is a drop-in replacement for DataLoader that looks ahead in the sampler's order and reads the upcoming files concurrently on a thread pool, keeping at most readahead_bytes in flight. Only once the bytes of a sample are in memory is it decoded, in the training process, through the dataset's own load_sample, so the samples are exactly the ones the dataset returns.
+# 
+# It works with any dataset that provides file_paths(idx) and load_sample(idx, files), and with any sampler, including ResumableRandomSampler and LossImportanceSampler.
+
+# In[ ]:
+
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data.dataloader import default_collate
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class ReadaheadLoader(object):
+    """Single-process data loader that reads ahead on a thread pool."""
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, num_threads=16,
+                 readahead_bytes=32 * 2**20, collate_fn=default_collate, drop_last=False):
+        """
+        Args:
+            dataset (Dataset): a dataset with file_paths(idx) and load_sample(idx, files).
+            batch_size, shuffle, sampler, collate_fn, drop_last: as for DataLoader.
+            num_threads (int): concurrent file reads.
+            readahead_bytes (int): bound on the bytes read ahead and not consumed yet.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        if sampler is None:
+            sampler = torch.utils.data.RandomSampler(dataset) if shuffle else torch.utils.data.SequentialSampler(dataset)
+        self.sampler = sampler
+        self.num_threads = num_threads
+        self.readahead_bytes = readahead_bytes
+        self.collate_fn = collate_fn
+        self.drop_last = drop_last
+        self.num_workers = 0
+        self.sample_bytes = 0 # running average of the bytes of one sample, 0 until the first one is read
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = iter(self.sampler)
+        pool = ThreadPoolExecutor(max_workers=self.num_threads)
+        pending = collections.deque() # (idx, futures of its files, bytes reserved for it)
+        state = {'inflight': 0, 'done': False}
+
+        def fill():
+            # always keep one sample pending; more only while the estimated bytes fit the budget
+            while not state['done'] and (not pending or (self.sample_bytes > 0 and
+                    state['inflight'] + self.sample_bytes <= self.readahead_bytes)):
+                idx = next(order, None)
+                if idx is None:
+                    state['done'] = True
+                    break
+                futures = [pool.submit(read_file, path) for path in self.dataset.file_paths(idx)]
+                pending.append((idx, futures, self.sample_bytes))
+                state['inflight'] += self.sample_bytes
+
+        try:
+            batch = []
+            fill()
+            while pending:
+                idx, futures, reserved = pending.popleft()
+                blobs = [future.result() for future in futures]
+                state['inflight'] -= reserved
+                size = sum(len(blob) for blob in blobs)
+                self.sample_bytes = size if self.sample_bytes == 0 else 0.9 * self.sample_bytes + 0.1 * size
+                fill()
+                batch.append(self.dataset.load_sample(idx, [io.BytesIO(blob) for blob in blobs]))
+                if len(batch) == self.batch_size:
+                    yield self.collate_fn(batch)
+                    batch = []
+            if batch and not self.drop_last:
+                yield self.collate_fn(batch)
+        finally:
+            for idx, futures, reserved in pending:
+                for future in futures:
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+
+# Compare one pass over the training images with the plain DataLoader and with readahead, then train the clip model from a ReadaheadLoader.
+
+# In[ ]:
+
+
+image_dataloader_train_readahead = ReadaheadLoader(image_dataset_train, batch_size=32, shuffle=True,
+                                                   num_threads=16, readahead_bytes=16 * 2**20)
+for name, loader in [('DataLoader', image_dataloader_train), ('ReadaheadLoader', image_dataloader_train_readahead)]:
+    start = timeit.default_timer()
+    for sample in loader:
+        pass
+    print('%-16s %.1f s per epoch' % (name, timeit.default_timer() - start))
+
+clip_dataloader_train_readahead = ReadaheadLoader(clip_dataset_train, batch_size=16, shuffle=True, num_threads=16)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_train_readahead, num_epochs=1)
+
+
+# ### Auto-tuning the data loader
+# 
+# The loaders above hard-code batch_size 4/16/32 and num_workers 0 or 4, and torch keeps its default number of intra-op threads. Depending on the machine this oversubscribes the cores or leaves them idle. autotune_loader runs a short calibration for a dataset/model pair: it measures end-to-end training samples/sec (loading, forward, backward and update) while sweeping num_workers, batch_size, prefetch_factor and torch.set_num_threads one at a time around the best configuration so far, for a couple of rounds. The winner is stored per host type (CPU model and core count) in a JSON file, and tuned_loader builds the loader from it in later runs.
+# 
+# The calibration trains a copy of the model, the model itself is not changed. Keep in mind that a different batch size may call for a different learning rate.
+
+# In[ ]:
+
+
+import platform
+
+tuning_path = os.path.join(os.path.expanduser('~'), '.cache', 'action_recognition', 'loader_tuning.json')
+
+def host_key():
+    '''
+    Identifies the host type: CPU model and number of cores.
+    '''
+    cpu_name = platform.processor() or platform.machine()
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu_name = line.split(':', 1)[1].strip()
+                    break
+    return '%s x%d' % (cpu_name, os.cpu_count())
+
+def make_loader(dataset, config, shuffle=True, drop_last=False):
+    kwargs = {}
+    if config['num_workers'] > 0:
+        kwargs['prefetch_factor'] = config['prefetch_factor']
+    return DataLoader(dataset, batch_size=config['batch_size'], shuffle=shuffle,
+                      num_workers=config['num_workers'], drop_last=drop_last, **kwargs)
+
+def measure_throughput(dataset, model, loss_fn, get_batch, config, steps=20, warmup=3):
+    '''
+    Training samples per second with the loader and thread settings of config.
+    '''
+    torch.set_num_threads(config['num_threads'])
+    model = copy.deepcopy(model)
+    model.train()
+    optimizer = optim.SGD(model.parameters(), lr=1e-6)
+    loader = make_loader(dataset, config, drop_last=True)
+    num_samples = 0
+    start = timeit.default_timer()
+    for t, sample in enumerate(loader):
+        if t == warmup:
+            # worker start-up and the first allocations are not part of the steady state
+            num_samples = 0
+            start = timeit.default_timer()
+        if t == warmup + steps:
+            break
+        x_var, y_var = get_batch(sample)
+        loss = loss_fn(model(x_var), y_var)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        num_samples += y_var.size(0)
+    elapsed = timeit.default_timer() - start
+    del loader
+    return num_samples / elapsed if num_samples > 0 else 0.0
+
+def load_tuning(path=tuning_path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def autotune_loader(name, dataset, model, loss_fn, get_batch, batch_sizes=(8, 16, 32, 64),
+                    num_workers=(0, 1, 2, 4, 8), prefetch_factors=(2, 4), num_threads=None,
+                    steps=20, rounds=2, path=tuning_path):
+    '''
+    Find the fastest loader configuration for dataset and model and store it as `name`
+    for this host type in path. Returns the best configuration.
+    '''
+    cpus = os.cpu_count()
+    if num_threads is None:
+        num_threads = sorted(set([1, 2, 4, 8, 16, 32, cpus]) & set(range(1, cpus + 1)))
+    space = [('num_workers', [w for w in num_workers if w <= cpus]), ('batch_size', list(batch_sizes)),
+             ('num_threads', list(num_threads)), ('prefetch_factor', list(prefetch_factors))]
+    default_threads = torch.get_num_threads()
+    best = {'batch_size': 16, 'num_workers': min(4, cpus), 'prefetch_factor': 2, 'num_threads': default_threads}
+    measured = {}
+
+    def throughput(config):
+        key = tuple(sorted(config.items()))
+        if key not in measured:
+            measured[key] = measure_throughput(dataset, model, loss_fn, get_batch, config, steps=steps)
+            print('%-70s %8.1f samples/s' % (config, measured[key]))
+        return measured[key]
+
+    best_rate = throughput(best)
+    for r in range(rounds):
+        for param, values in space:
+            if param == 'prefetch_factor' and best['num_workers'] == 0:
+                continue
+            for value in values:
+                config = dict(best, **{param: value})
+                rate = throughput(config)
+                if rate > best_rate:
+                    best, best_rate = config, rate
+    torch.set_num_threads(default_threads)
+    print('Best: %s, %.1f samples/s' % (best, best_rate))
+
+    tuning = load_tuning(path)
+    tuning.setdefault(host_key(), {})[name] = dict(best, samples_per_sec=best_rate)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(tuning, f, indent=1)
+    os.rename(path + '.tmp', path)
+    return best
+
+def tuned_loader(name, dataset, shuffle=True, default=None, path=tuning_path):
+    '''
+    DataLoader with the configuration autotune_loader stored for `name` on this host type,
+    or with default (batch_size 16, 4 workers) if there is none. Also sets torch's number of threads.
+    '''
+    config = load_tuning(path).get(host_key(), {}).get(name)
+    if config is None:
+        config = default or {'batch_size': 16, 'num_workers': 4, 'prefetch_factor': 2,
+                             'num_threads': torch.get_num_threads()}
+    torch.set_num_threads(config['num_threads'])
+    return make_loader(dataset, config, shuffle=shuffle)
+
+
+# Tune the clip loader for fixed_model_3d once per host type; later runs only need tuned_loader.
+
+# In[ ]:
+
+
+if load_tuning().get(host_key(), {}).get('clips_3d') is None:
+    autotune_loader('clips_3d', clip_dataset_train, fixed_model_3d, loss_fn, clip_batch)
+clip_dataloader_tuned = tuned_loader('clips_3d', clip_dataset_train, shuffle=True)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_tuned, num_epochs=1)
+
+
+# ### Ensemble and test-time augmentation in one pass
+# 
+# predict_on_test and predict_on_test_3d each decode the whole test set to run a single model. predict_ensemble decodes every clip once and feeds the same batch to several models: the 2D models see all frames of the clip (their scores are averaged over the frames), the 3D models see the clip. Optional test-time augmentation views, a horizontal flip ('flip') and a center crop resized back to 64x64 ('crop'), are stacked into one larger batch instead of running extra loops. The softmax probabilities are averaged over views and models (optionally weighted), and the fused predictions are written in the same format as results.csv. If the loader has labels, the ensemble accuracy is printed as well.
+
+# In[ ]:
+
+
+def tta_views(clips, views=(), crop=56):
+    '''
+    Stack the augmented views of a N x C x T x H x W batch along the batch dimension.
+    Returns the (V * N) x C x T x H x W batch and the number of views V.
+    '''
+    N, C, D, H, W = clips.size()
+    stacked = [clips]
+    if 'flip' in views:
+        stacked.append(clips.flip(4))
+    if 'crop' in views:
+        top, left = (H - crop) // 2, (W - crop) // 2
+        cropped = clips[:, :, :, top:top + crop, left:left + crop].reshape(N, C * D, crop, crop)
+        stacked.append(nn.functional.interpolate(cropped, size=(H, W), mode='bilinear',
+                                                 align_corners=False).view(N, C, D, H, W))
+    return torch.cat(stacked, 0), len(stacked)
+
+def predict_ensemble(loader, models_2d=(), models_3d=(), views=(), weights=None, out_file='results_ensemble.csv',
+                     metrics=None):
+    '''
+    Fused predictions of models_2d (frame models such as fixed_model_base) and models_3d
+    (clip models such as fixed_model_3d) on the clips of loader. weights gives one weight per
+    model, 2D models first. Writes out_file unless it is None and returns the predictions.
+    metrics (a Telemetry) records the batch timings under the phase 'predict'.
+    '''
+    models = list(models_2d) + list(models_3d)
+    weights = weights if weights is not None else [1.0] * len(models)
+    for model in models:
+        model.eval()
+    all_preds = []
+    num_correct = 0
+    if metrics is not None:
+        metrics.start('predict')
+    with torch.no_grad():
+        for t, sample in enumerate(loader):
+            if metrics is not None:
+                metrics.batch_ready()
+            clips = clip_preprocess(sample['clip'])
+            N, C, D, H, W = clips.size()
+            x, V = tta_views(clips, views)
+            probs = 0
+            if models_2d:
+                # every frame of every view is one image for the 2D models
+                frames = x.permute(0, 2, 1, 3, 4).reshape(V * N * D, C, H, W)
+                # padded frames of shorter clips are left out of the frame average
+                frame_mask = frame_weights(sample, N, D).view(1, N, D, 1).type_as(x)
+            for i, (model, weight) in enumerate(zip(models, weights)):
+                if i < len(models_2d):
+                    p = (nn.functional.softmax(model(frames), dim=1).view(V, N, D, -1) * frame_mask).sum(2).mean(0)
+                else:
+                    p = nn.functional.softmax(model(x), dim=1).view(V, N, -1).mean(0)
+                probs = probs + weight * p
+            _, preds = probs.max(1)
+            all_preds.append(preds)
+            if 'Label' in sample:
+                num_correct += (preds == sample['Label'].long()).sum().item()
+            if metrics is not None:
+                metrics.step_done(N)
+    preds = torch.cat(all_preds)
+    if 'Label' in sample:
+        print('Ensemble: got %d / %d correct (%.2f)' % (num_correct, len(preds), 100.0 * num_correct / len(preds)))
+    if out_file is not None:
+        results=open(out_file,'w')
+        results.write('Id'+','+'Class'+'\n')
+        for count in range(len(preds)):
+            results.write(str(count)+','+str(preds[count].item())+'\n')
+        results.close()
+    return preds
+
+
+# Check the ensemble on the validation clips, then write the fused test predictions.
+
+# In[ ]:
+
+
+clip_dataloader_val_ordered = DataLoader(clip_dataset_val, batch_size=16, shuffle=False, num_workers=4)
+predict_ensemble(clip_dataloader_val_ordered, [fixed_model], [fixed_model_3d], views=('flip', 'crop'), out_file=None)
+preds = predict_ensemble(clip_dataloader_test, [fixed_model], [fixed_model_3d], views=('flip', 'crop'),
+                         out_file='results_ensemble.csv')
+print(len(preds))
+
+
+# ### Clip embeddings and nearest-neighbour search
+# 
+# For "find similar actions" we do not need the class, we need a vector per clip. export_embeddings takes the features the final nn.Linear receives (the penultimate layer) from a 2D model (averaged over the frames of the clip) or from a 3D model. It L2-normalizes them and writes them as row sample['idx'] of a memory-mapped float16 .npy matrix. With pool=True the feature map is averaged over its spatial (and temporal) positions before flattening, so the vectors have one value per channel (256 for fixed_model_base, 128 for fixed_model_3d) instead of tens of thousands. That is the practical choice for large archives.
+# 
+# ClipIndex answers queries on that matrix without touching the conv net again:
+# 
+# * search: exact top-k cosine similarity, computed as batched matrix multiplies over chunks of the matrix.
+# * build_ivf / search_ivf: approximate search for millions of clips. An inverted file (IVF) groups the clips under nlist k-means centroids, and the residual to the centroid is compressed with product quantization (PQ) to m bytes per clip. A query only scans the nprobe nearest lists, with distances read from small lookup tables, and the best candidates are re-ranked with their exact vectors.
+
+# In[ ]:
+
+
+def feature_extractor(model, pool=False):
+    '''
+    The layers of the nn.Sequential model in front of its last nn.Linear. With pool=True the
+    layers in front of the flatten layer instead; the features are then averaged over positions.
+    '''
+    layers = list(model)
+    if pool:
+        cut = [i for i, layer in enumerate(layers) if isinstance(layer, (Flatten, Flatten3d))][0]
+    else:
+        cut = [i for i, layer in enumerate(layers) if isinstance(layer, nn.Linear)][-1]
+    return nn.Sequential(*layers[:cut])
+
+def embed(extractor, x, pool=False):
+    features = extractor(x)
+    if pool:
+        return features.view(features.size(0), features.size(1), -1).mean(2)
+    return features.view(features.size(0), -1)
+
+def export_embeddings(model, loader, path, is_3d=False, pool=True, num_rows=None, append=False):
+    '''
+    Write one L2-normalized float16 embedding per clip of loader (a clip loader) to the .npy
+    file path, at row sample['idx']. The matrix has num_rows rows, len(loader.dataset) by
+    default. With append=True an existing matrix is grown to num_rows and only the rows of
+    the clips in loader are written. Returns the memory-mapped matrix.
+    '''
+    extractor = feature_extractor(model, pool)
+    extractor.eval()
+    matrix = None
+    with torch.no_grad():
+        for t, sample in enumerate(loader):
+            clips = clip_preprocess(sample['clip'])
+            if is_3d:
+                features = embed(extractor, clips, pool)
+            else:
+                N, C, D, H, W = clips.size()
+                frames = clips.permute(0, 2, 1, 3, 4).reshape(N * D, C, H, W)
+                features = embed(extractor, frames, pool).view(N, D, -1)
+                # average over the real frames only, not the padding of pad_clips_collate
+                features = (features * frame_weights(sample, N, D).view(N, D, 1).type_as(features)).sum(1)
+            features = nn.functional.normalize(features, dim=1)
+            if matrix is None:
+                num_rows = num_rows if num_rows is not None else len(loader.dataset)
+                if append and os.path.exists(path):
+                    grow_npy(path, num_rows)
+                    matrix = np.load(path, mmap_mode='r+')
+                else:
+                    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                                       shape=(num_rows, features.size(1)))
+            matrix[sample['idx'].numpy()] = features.numpy().astype(np.float16)
+    matrix.flush()
+    return matrix
+
+def nearest_centroid(x, centroids, chunk=65536):
+    # argmin |x - c|^2 == argmax 2 x.c - |c|^2
+    c_norm = (centroids * centroids).sum(1)
+    assign = []
+    for start in range(0, len(x), chunk):
+        assign.append((2 * x[start:start + chunk].mm(centroids.t()) - c_norm).max(1)[1])
+    return torch.cat(assign)
+
+def kmeans(x, k, iters=20, seed=0):
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    k = min(k, len(x))
+    centroids = x[torch.randperm(len(x), generator=generator)[:k]].clone()
+    for i in range(iters):
+        assign = nearest_centroid(x, centroids)
+        counts = torch.bincount(assign, minlength=k)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        centroids = sums / counts.clamp(min=1).float().unsqueeze(1)
+        empty = (counts == 0).nonzero().view(-1)
+        if len(empty) > 0:
+            # restart empty clusters on random points
+            centroids[empty] = x[torch.randint(len(x), (len(empty),), generator=generator)]
+    return centroids
+
+
+class ClipIndex(object):
+    """Exact and IVF-PQ nearest-neighbour search over an embedding matrix."""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (string): .npy embedding matrix written by export_embeddings.
+        """
+        self.path = path
+        self.matrix = np.load(path, mmap_mode='r')
+        self.ivf = None
+
+    def rows(self, start, stop):
+        return torch.from_numpy(np.asarray(self.matrix[start:stop], dtype=np.float32))
+
+    def query_vectors(self, queries):
+        queries = torch.as_tensor(np.asarray(queries, dtype=np.float32))
+        return nn.functional.normalize(queries.view(-1, self.matrix.shape[1]), dim=1)
+
+    def search(self, queries, k=10, chunk=65536):
+        '''
+        Exact top-k cosine similarities. Returns (scores, ids), both num_queries x k.
+        '''
+        queries = self.query_vectors(queries)
+        best_scores = torch.full((len(queries), 0), -2.0)
+        best_ids = torch.zeros(len(queries), 0).long()
+        for start in range(0, self.matrix.shape[0], chunk):
+            scores = queries.mm(self.rows(start, start + chunk).t())
+            scores, ids = scores.topk(min(k, scores.size(1)), dim=1)
+            best_scores = torch.cat([best_scores, scores], 1)
+            best_ids = torch.cat([best_ids, ids + start], 1)
+            best_scores, order = best_scores.topk(min(k, best_scores.size(1)), dim=1)
+            best_ids = best_ids.gather(1, order)
+        return best_scores, best_ids
+
+    def build_ivf(self, nlist=1024, m=16, train_size=100000, iters=20, chunk=65536, seed=0):
+        '''
+        Build the IVF-PQ structure: nlist coarse centroids and m one-byte sub-quantizers.
+        The dimension of the embeddings must be divisible by m.
+        '''
+        N, D = self.matrix.shape
+        assert D % m == 0, 'embedding dimension %d is not divisible by m=%d' % (D, m)
+        rng = np.random.RandomState(seed)
+        sample_ids = np.sort(rng.choice(N, min(N, train_size), replace=False))
+        train = torch.from_numpy(np.asarray(self.matrix[sample_ids], dtype=np.float32))
+        centroids = kmeans(train, nlist, iters, seed)
+        residuals = (train - centroids[nearest_centroid(train, centroids)]).view(len(train), m, D // m)
+        codebooks = torch.stack([kmeans(residuals[:, j], 256, iters, seed) for j in range(m)])
+        self.ivf = {'centroids': centroids, 'codebooks': codebooks, 'ids': torch.zeros(0).long(),
+                    'codes': torch.zeros(0, m, dtype=torch.uint8), 'offsets': torch.zeros(len(centroids) + 1).long()}
+        self.add_to_ivf(chunk=chunk)
+        return self.ivf
+
+    def add_to_ivf(self, start=None, chunk=65536):
+        '''
+        Encode the rows from start to the end of the matrix with the existing centroids and
+        codebooks and add them to the inverted lists. Used after the matrix has grown. Rows
+        that are already indexed are never added again; by default all new rows are added.
+        '''
+        ivf = self.ivf
+        self.matrix = np.load(self.path, mmap_mode='r')
+        centroids, codebooks = ivf['centroids'], ivf['codebooks']
+        m, ksub, dsub = codebooks.size()
+        N = self.matrix.shape[0]
+        # rows are always indexed in order, so everything below the largest id is indexed
+        indexed = int(ivf['ids'].max()) + 1 if len(ivf['ids']) > 0 else 0
+        start = indexed if start is None else max(start, indexed)
+        if start >= N:
+            return
+        assign = torch.zeros(N - start).long()
+        codes = torch.zeros(N - start, m, dtype=torch.uint8)
+        for begin in range(start, N, chunk):
+            x = self.rows(begin, begin + chunk)
+            a = nearest_centroid(x, centroids)
+            r = (x - centroids[a]).view(len(x), m, dsub)
+            assign[begin - start:begin - start + len(x)] = a
+            for j in range(m):
+                codes[begin - start:begin - start + len(x), j] = nearest_centroid(r[:, j], codebooks[j]).byte()
+        # inverted lists: the clip ids sorted by list, and where each list starts
+        list_sizes = ivf['offsets'][1:] - ivf['offsets'][:-1]
+        old_assign = torch.arange(len(centroids)).repeat_interleave(list_sizes)
+        assign = torch.cat([old_assign, assign])
+        ids = torch.cat([ivf['ids'], torch.arange(start, N)])
+        codes = torch.cat([ivf['codes'], codes])
+        order = assign.sort(stable=True)[1]
+        ivf['ids'], ivf['codes'] = ids[order], codes[order]
+        ivf['offsets'] = torch.cat([torch.zeros(1).long(), torch.bincount(assign, minlength=len(centroids)).cumsum(0)])
+
+    def save_ivf(self, path):
+        np.savez(path, **dict((key, value.numpy()) for key, value in self.ivf.items()))
+
+    def load_ivf(self, path):
+        data = np.load(path)
+        self.ivf = dict((key, torch.from_numpy(data[key])) for key in data.files)
+
+    def search_ivf(self, queries, k=10, nprobe=16, rerank=100):
+        '''
+        Approximate top-k: scan the nprobe closest lists with PQ distances, then re-rank the
+        best `rerank` candidates with their exact vectors (0 returns the PQ estimate).
+        Returns (scores, ids) like search. Queries whose probed lists hold fewer than k vectors
+        are padded with id -1 and score -inf.
+        '''
+        ivf = self.ivf
+        centroids, codebooks, offsets = ivf['centroids'], ivf['codebooks'], ivf['offsets']
+        m, ksub, dsub = codebooks.size()
+        queries = self.query_vectors(queries)
+        probes = (2 * queries.mm(centroids.t()) - (centroids * centroids).sum(1)).topk(min(nprobe, len(centroids)), dim=1)[1]
+        all_scores, all_ids = [], []
+        for q, query in enumerate(queries):
+            cand_ids, cand_dists = [], []
+            for c in probes[q].tolist():
+                start, stop = offsets[c].item(), offsets[c + 1].item()
+                if start == stop:
+                    continue
+                residual = (query - centroids[c]).view(m, 1, dsub)
+                tables = ((codebooks - residual) ** 2).sum(2) # m x 256 squared distances
+                codes = ivf['codes'][start:stop].long()
+                cand_dists.append(tables.gather(1, codes.t()).sum(0))
+                cand_ids.append(ivf['ids'][start:stop])
+            if not cand_ids:
+                # every probed list is empty
+                all_scores.append(torch.full((k,), float('-inf')))
+                all_ids.append(torch.full((k,), -1, dtype=torch.long))
+                continue
+            cand_ids, cand_dists = torch.cat(cand_ids), torch.cat(cand_dists)
+            keep = cand_dists.topk(min(max(k, rerank), len(cand_dists)), largest=False)[1]
+            cand_ids = cand_ids[keep]
+            if rerank:
+                sorted_ids = np.sort(cand_ids.numpy())
+                vectors = torch.from_numpy(np.asarray(self.matrix[sorted_ids], dtype=np.float32))
+                scores = vectors.mv(query)
+                cand_ids = torch.from_numpy(sorted_ids)
+            else:
+                scores = 1 - cand_dists[keep] / 2 # cosine similarity of unit vectors
+            scores, order = scores.topk(min(k, len(scores)))
+            missing = k - len(scores)
+            all_scores.append(torch.cat([scores.float(), torch.full((missing,), float('-inf'))]))
+            all_ids.append(torch.cat([cand_ids[order].long(), torch.full((missing,), -1, dtype=torch.long)]))
+        return torch.stack(all_scores), torch.stack(all_ids)
+
+
+# Export the pooled fixed_model_3d embeddings of the training clips, then find the clips most similar to the first validation clip, exactly and with IVF-PQ.
+
+# In[ ]:
+
+
+clip_dataloader_train_ordered = DataLoader(clip_dataset_train, batch_size=16, shuffle=False, num_workers=4)
+export_embeddings(fixed_model_3d, clip_dataloader_train_ordered, 'embeddings_3d.npy', is_3d=True, pool=True)
+clip_index = ClipIndex('embeddings_3d.npy')
+clip_index.build_ivf(nlist=64, m=16)
+clip_index.save_ivf('embeddings_3d_ivf.npz')
+
+query_clips = clip_preprocess(next(iter(clip_dataloader_val_ordered))['clip'])
+extractor = feature_extractor(fixed_model_3d, pool=True)
+extractor.eval()
+with torch.no_grad():
+    query = embed(extractor, query_clips[:1], pool=True)
+for name, search in [('exact', clip_index.search), ('ivf-pq', clip_index.search_ivf)]:
+    start = timeit.default_timer()
+    scores, ids = search(query, k=5)
+    print('%-7s %.2f ms  clips %s  labels %s' % (name, 1000 * (timeit.default_timer() - start),
+                                                 [format(i + 1, '05d') for i in ids[0].tolist()],
+                                                 [label_train[i][0] - 1 for i in ids[0].tolist()]))
+
+
+# ### Growing the dataset and warm-start fine-tuning
+# 
+# New labelled clips arrive every day. append_clips adds them to an existing clip directory under the next clip numbers and appends their labels to hw6_data.mat. The clips are copied into a staging directory next to the clip directory and only renamed into it once complete, so the clip directory never holds a partial clip. If a shard directory is given, only the new clips are packed into new shards appended to its manifest. The caches grow in place as well: TeacherLogitCache keeps the scores it already has, export_embeddings(..., append=True) writes only the new rows and ClipIndex.add_to_ivf adds them to the inverted lists. (The old rows keep the embeddings of the weights they were computed with; re-export the whole matrix once in a while.)
+# 
+# Instead of training from reset, a refresh loads the weights of the newest checkpoint (warm_start) and fine-tunes on all new clips plus a random replay sample of old clips (ReplaySampler), which keeps the model from forgetting the old data. Each refresh writes its checkpoints to its own directory, named after the clips of its batch, and train_loop always ends with a checkpoint of the final weights, so a crashed refresh resumes exactly and the next one starts from its result.
+
+# In[ ]:
+
+
+import shutil
+import time
+
+def append_clips(root_dir, mat_path, label_key, new_clip_dirs, new_labels, shard_dir=None):
+    '''
+    Append the clip directories new_clip_dirs, with their 1-based labels new_labels, to the
+    clip directory root_dir and to label_key in mat_path. Returns the new 1-based clip numbers.
+    '''
+    assert len(new_clip_dirs) == len(new_labels)
+    first = len(os.listdir(root_dir)) + 1
+    clips = list(range(first, first + len(new_clip_dirs)))
+
+    # labels first: a clip directory without a label would break the dataset, an extra label does not
+    label_mat = scipy.io.loadmat(mat_path)
+    labels = np.concatenate([label_mat[label_key][:first - 1],
+                             np.asarray(new_labels).reshape(-1, 1).astype(label_mat[label_key].dtype)])
+    label_mat = dict((key, value) for key, value in label_mat.items() if not key.startswith('__'))
+    label_mat[label_key] = labels
+    scipy.io.savemat(mat_path + '.tmp.mat', label_mat)
+    os.rename(mat_path + '.tmp.mat', mat_path)
+
+    # clips are copied next to root_dir, not into it: root_dir must only ever hold complete
+    # clips, since the number of its entries is the dataset length and the next clip number
+    staging_dir = os.path.normpath(root_dir) + '.staging'
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir) # left over from an interrupted copy
+    for clip, clip_dir in zip(clips, new_clip_dirs):
+        tmp_dir = os.path.join(staging_dir, format(clip, '05d'))
+        os.makedirs(tmp_dir)
+        for i, path in enumerate(clip_frame_paths(clip_dir)):
+            shutil.copyfile(path, os.path.join(tmp_dir, str(i + 1) + '.jpg'))
+        os.rename(tmp_dir, os.path.join(root_dir, format(clip, '05d')))
+    if os.path.exists(staging_dir):
+        os.rmdir(staging_dir)
+
+    if shard_dir is not None:
+        write_shards(root_dir, shard_dir, labels, clips=clips)
+    return clips
+
+def ingest_incoming(incoming_dir, root_dir, mat_path, label_key, shard_dir=None, ingested_dir='ingested'):
+    '''
+    append_clips for the clip directories listed in incoming_dir/labels.csv ("clip directory,label").
+    incoming_dir is first moved to ingested_dir/<time>, and clips.txt there records the new clip
+    numbers once they are appended, so no clip is ever appended twice. Returns the clip numbers
+    of the newest ingested batch: the one just appended, or the previous one if nothing came in.
+    '''
+    if os.path.exists(os.path.join(incoming_dir, 'labels.csv')):
+        batch_dir = os.path.join(ingested_dir, time.strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(ingested_dir, exist_ok=True)
+        os.rename(incoming_dir, batch_dir)
+        os.makedirs(incoming_dir)
+        with open(os.path.join(batch_dir, 'labels.csv')) as f:
+            incoming = [line.strip().split(',') for line in f if line.strip()]
+        clips = append_clips(root_dir, mat_path, label_key, [os.path.join(batch_dir, name) for name, label in incoming],
+                             [int(label) for name, label in incoming], shard_dir=shard_dir)
+        with open(os.path.join(batch_dir, 'clips.txt'), 'w') as f:
+            f.write('\n'.join(str(clip) for clip in clips) + '\n')
+    batches = sorted(os.listdir(ingested_dir)) if os.path.isdir(ingested_dir) else []
+    if not batches:
+        return []
+    clips_path = os.path.join(ingested_dir, batches[-1], 'clips.txt')
+    if not os.path.exists(clips_path):
+        raise RuntimeError('ingestion of %s was interrupted, check %s before appending again'
+                           % (os.path.join(ingested_dir, batches[-1]), root_dir))
+    with open(clips_path) as f:
+        return [int(line) for line in f if line.strip()]
+
+def latest_checkpoint(root):
+    '''
+    Newest checkpoint_*.pt file anywhere under root, or None.
+    '''
+    paths = glob.glob(os.path.join(root, '**', 'checkpoint_*.pt'), recursive=True)
+    return max(paths, key=os.path.getmtime) if paths else None
+
+def warm_start(model, root):
+    '''
+    Load the model weights of the newest checkpoint under root. Returns its path, or None.
+    '''
+    path = latest_checkpoint(root)
+    if path is not None:
+        model.load_state_dict(torch.load(path, map_location='cpu', weights_only=False)['model'])
+        print('Warm start from %s' % path)
+    return path
+
+
+class ReplaySampler(ResumableSampler):
+    """All new samples plus a fresh random sample of old ones every epoch, shuffled together."""
+
+    def __init__(self, new_indices, old_indices, replay_ratio=1.0, seed=0):
+        """
+        Args:
+            new_indices (list): dataset indices of the new samples.
+            old_indices (list): dataset indices of the samples seen before.
+            replay_ratio (float): old samples replayed per new sample.
+            seed (int): base seed, combined with the epoch.
+        """
+        super(ReplaySampler, self).__init__(seed)
+        self.new_indices = torch.LongTensor(list(new_indices))
+        self.old_indices = torch.LongTensor(list(old_indices))
+        self.num_replay = min(len(self.old_indices), int(round(replay_ratio * len(self.new_indices))))
+
+    def order(self):
+        generator = self.generator()
+        replay = self.old_indices[torch.randperm(len(self.old_indices), generator=generator)[:self.num_replay]]
+        indices = torch.cat([self.new_indices, replay])
+        return indices[torch.randperm(len(indices), generator=generator)].tolist()
+
+    def __len__(self):
+        return len(self.new_indices) + self.num_replay - self.start
+
+
+# Nightly refresh: append the clips in incoming/ (labels in incoming/labels.csv as "clip directory,label") and move them to ingested/, update the shards, the teacher cache and the embeddings, then fine-tune fixed_model_3d from the newest checkpoint on the new clips plus twice as many replayed old clips.
+
+# In[ ]:
+
+
+new_clips = ingest_incoming('incoming', data_dir + 'trainClips', label_path, 'trLb', shard_dir='shards/train')
+
+if not new_clips:
+    print('No new clips, nothing to refresh')
+else:
+    label_train = scipy.io.loadmat(label_path)['trLb']
+    clip_dataset_train = ActionClipDataset(root_dir=data_dir + 'trainClips', labels=label_train, transform=T.ToTensor())
+    teacher_cache_3d = TeacherLogitCache('teacher_3d_train', len(clip_dataset_train))
+
+    new_indices = [clip - 1 for clip in new_clips]
+    replay_sampler = ReplaySampler(new_indices, range(new_indices[0]), replay_ratio=2.0, seed=12345)
+    clip_dataloader_refresh = DataLoader(clip_dataset_train, batch_size=16, sampler=replay_sampler, num_workers=4)
+
+    # one directory per ingested batch: re-running the cell resumes (or finds finished) the refresh of this batch
+    refresh_dir = os.path.join('checkpoints_3d', 'refresh-%05d-%05d' % (new_clips[0], new_clips[-1]))
+    refresh_checkpointer = AsyncCheckpointer(refresh_dir, every=200)
+    if refresh_checkpointer.latest() is None:
+        warm_start(fixed_model_3d, 'checkpoints_3d')
+    optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-5)
+    train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_refresh, num_epochs=2, checkpointer=refresh_checkpointer)
+    check_accuracy_3d(fixed_model_3d, clip_dataloader_val)
+
+    clip_dataloader_new = DataLoader(torch.utils.data.Subset(clip_dataset_train, new_indices), batch_size=16, num_workers=4)
+    export_embeddings(fixed_model_3d, clip_dataloader_new, 'embeddings_3d.npy', is_3d=True, pool=True,
+                      num_rows=len(clip_dataset_train), append=True)
+    clip_index = ClipIndex('embeddings_3d.npy')
+    clip_index.load_ivf('embeddings_3d_ivf.npz')
+    clip_index.add_to_ivf() # only the rows that are not indexed yet
+    clip_index.save_ivf('embeddings_3d_ivf.npz')
+
+
+# ### Clips of different lengths
+# 
+# Real footage does not come in clips of exactly 3 frames. ActionClipDataset reads however many frames (1.jpg ... n.jpg) a clip directory holds, and fixed_model_3d averages its feature maps over time before the Linear layer, so it accepts clips of any length. To batch clips of different lengths, pad_clips_collate pads every clip of a batch to the longest one by repeating its last frame and records the real lengths in sample['length']; predict_ensemble and export_embeddings average the frames of a clip with frame_weights, which leaves the padding out. Padding is wasted Conv3d compute, so BucketBatchSampler groups clips of similar length into the same batches: the clips are sorted into buckets of bucket_width frames, shuffled within their bucket, cut into batches, and the batches are shuffled. Like ResumableRandomSampler and ReplaySampler it is a ResumableSampler, so training with it resumes exactly.
+
+# In[ ]:
+
+
+def frame_weights(sample, N, D):
+    '''
+    N x D weights that average the frames of each clip of a batch: 1 / length for the real
+    frames, 0 for the padding that pad_clips_collate added (all frames are real without 'length').
+    '''
+    lengths = sample['length'].float() if 'length' in sample else torch.full((N,), float(D))
+    frame_mask = (torch.arange(D).float().view(1, -1) < lengths.view(-1, 1)).float()
+    return frame_mask / lengths.view(-1, 1)
+
+def pad_clips_collate(batch):
+    '''
+    default_collate for clips of different lengths: 'clip' is padded along time to the
+    longest clip of the batch, 'length' holds the number of real frames of each clip.
+    '''
+    lengths = [sample['clip'].size(0) for sample in batch]
+    max_length = max(lengths)
+    clips = []
+    for sample, length in zip(batch, lengths):
+        clip = sample['clip']
+        if length < max_length:
+            clip = torch.cat([clip, clip[-1:].expand((max_length - length,) + tuple(clip.size()[1:]))], 0)
+        clips.append(clip)
+    collated = default_collate([dict((key, value) for key, value in sample.items() if key != 'clip') for sample in batch])
+    collated['clip'] = torch.stack(clips)
+    collated['length'] = torch.LongTensor(lengths)
+    return collated
+
+
+class BucketBatchSampler(ResumableSampler):
+    """Batches of clips of similar length, in random order."""
+
+    def __init__(self, lengths, batch_size, bucket_width=1, shuffle=True, drop_last=False, seed=0):
+        """
+        Args:
+            lengths (list): number of frames of every clip, e.g. ActionClipDataset.clip_lengths().
+            batch_size (int): clips per batch.
+            bucket_width (int): clips whose lengths fall in the same bucket_width frames share batches.
+            shuffle (bool): shuffle within buckets and the order of the batches.
+            drop_last (bool): drop the incomplete last batch of every bucket.
+            seed (int): base seed, combined with the epoch.
+        """
+        super(BucketBatchSampler, self).__init__(seed)
+        self.buckets = collections.defaultdict(list)
+        for idx, length in enumerate(lengths):
+            self.buckets[length // bucket_width].append(idx)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def skip_batches(self, num_batches):
+        self.skip(num_batches)
+
+    def order(self):
+        generator = self.generator()
+        batches = []
+        for key in sorted(self.buckets):
+            bucket = torch.LongTensor(self.buckets[key])
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket), generator=generator)]
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start:start + self.batch_size].tolist()
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+
+# Train fixed_model_3d on clips of mixed lengths with length-bucketed batches.
+
+# In[ ]:
+
+
+clip_bucket_sampler = BucketBatchSampler(clip_dataset_train.clip_lengths(), batch_size=16, seed=12345)
+clip_dataloader_bucketed = DataLoader(clip_dataset_train, batch_sampler=clip_bucket_sampler,
+                                      collate_fn=pad_clips_collate, num_workers=4)
+clip_dataloader_val_bucketed = DataLoader(clip_dataset_val,
+                                          batch_sampler=BucketBatchSampler(clip_dataset_val.clip_lengths(), 16, shuffle=False),
+                                          collate_fn=pad_clips_collate, num_workers=4)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_bucketed, num_epochs=3)
+check_accuracy_3d(fixed_model_3d, clip_dataloader_val_bucketed)
+
+
+
+# ### Training telemetry
+# 
+# Telemetry collects metrics from train_loop, evaluate and predict_ensemble (pass metrics=telemetry) and exports them for monitoring: counters of steps and samples, histograms of the time spent waiting for the next batch (data_wait_seconds), of the time spent on the batch itself (step_seconds) and of whole evaluations (eval_seconds), and gauges for samples per second, the fraction of time spent waiting for data, the resident memory and the number of open file handles, plus the loss and accuracies of the last epoch. The hot path only takes two timestamps per step and updates a histogram bucket; memory, file handles and throughput are sampled every sample_every steps.
+# 
+# Every export_every seconds the metrics are written as Prometheus text to prom_path (the file format read by the node_exporter textfile collector, replaced atomically) and appended as one JSON line to jsonl_path. serve(port) exposes the same Prometheus text over HTTP for a scraper, on 127.0.0.1 unless another host is given. Every series carries the job and host labels, so runs from many machines can share one dashboard and alerts can be set on samples_per_second and data_wait_fraction.
+# 
+# With CUDA, kernels run asynchronously and their time is counted wherever the host next waits for the GPU, usually the next step. The totals are still right; for exact per-step latencies set sync=True, which synchronizes after every step and costs some overlap.
+
+# In[ ]:
+
+
+import bisect
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the HTTP servers started by Telemetry.serve, by (host, port)
+metrics_servers = {}
+
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def process_memory():
+    '''
+    Resident memory of this process in bytes and its number of open file handles (None if unknown).
+    '''
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        return rss, len(os.listdir('/proc/self/fd'))
+    import resource
+    # peak rather than current on systems without /proc; ru_maxrss is in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss * (1 if platform.system() == 'Darwin' else 1024), None
+
+class Telemetry(object):
+    """Counters, histograms and gauges of training and inference loops, exported periodically."""
+
+    def __init__(self, job, prom_path=None, jsonl_path=None, export_every=30, sample_every=50, sync=False,
+                 namespace='action_recognition'):
+        """
+        Args:
+            job (string): name of the run, exported as the job label.
+            prom_path (string, optional): Prometheus text file, rewritten on every export.
+            jsonl_path (string, optional): JSON lines file, one line appended on every export.
+            export_every (float): seconds between exports.
+            sample_every (int): steps between samples of throughput, memory and file handles.
+            sync (bool): wait for CUDA kernels after every step for exact step latencies.
+            namespace (string): prefix of the metric names.
+        """
+        self.labels = {'job': job, 'host': socket.gethostname()}
+        self.prom_path = prom_path
+        self.jsonl_path = jsonl_path
+        self.export_every = export_every
+        self.sample_every = sample_every
+        self.sync = sync and torch.cuda.is_available()
+        self.namespace = namespace
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.phase = 'train'
+        self.mark = timeit.default_timer()
+        self.batch_start = self.mark
+        self.last_export = self.mark
+        self.window = {}
+        self.paused = {}
+
+    def inc(self, name, value=1, phase=None):
+        key = (name, phase)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, phase=None):
+        with self.lock:
+            self.gauges[(name, phase)] = value
+
+    def observe(self, name, value, phase=None):
+        key = (name, phase)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+            histogram = self.histograms[key]
+            histogram['buckets'][bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def quantile(self, name, q, phase=None):
+        '''
+        Upper bucket bound below which a fraction q of the observations of histogram name fall.
+        '''
+        histogram = self.histograms.get((name, phase))
+        if histogram is None or histogram['count'] == 0:
+            return None
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + (float('inf'),), histogram['buckets']):
+            seen += count
+            if seen >= q * histogram['count']:
+                return bound
+
+    def start(self, phase='train'):
+        '''
+        Called before iterating over a loader; the wait for the first batch counts as data wait.
+        The throughput window of the phase keeps running across calls (e.g. around the
+        validations in the middle of an epoch), without the time spent in the other phases.
+        '''
+        now = timeit.default_timer()
+        if phase != self.phase:
+            # the last step of the phase that is left ended at self.mark
+            self.paused[self.phase] = self.mark
+        if phase in self.window and phase in self.paused:
+            window_start, window_samples, window_wait, window_steps = self.window[phase]
+            self.window[phase] = (window_start + now - self.paused[phase], window_samples, window_wait, window_steps)
+        self.paused.pop(phase, None)
+        self.phase = phase
+        self.mark = now
+
+    def batch_ready(self):
+        now = timeit.default_timer()
+        self.observe('data_wait_seconds', now - self.mark, self.phase)
+        self.batch_start = now
+
+    def step_done(self, num_samples):
+        if self.sync:
+            torch.cuda.synchronize()
+        now = timeit.default_timer()
+        phase = self.phase
+        self.observe('step_seconds', now - self.batch_start, phase)
+        self.inc('steps_total', 1, phase)
+        self.inc('samples_total', num_samples, phase)
+        window_start, window_samples, window_wait, window_steps = self.window.get(phase, (self.mark, 0, 0.0, 0))
+        window_samples += num_samples
+        window_wait += self.batch_start - self.mark
+        window_steps += 1
+        if window_steps >= self.sample_every:
+            self.set('samples_per_second', window_samples / max(now - window_start, 1e-9), phase)
+            self.set('data_wait_fraction', window_wait / max(now - window_start, 1e-9), phase)
+            self.sample_process()
+            window_start, window_samples, window_wait, window_steps = now, 0, 0.0, 0
+        self.window[phase] = (window_start, window_samples, window_wait, window_steps)
+        if now - self.last_export >= self.export_every:
+            self.export()
+        # taken after the export, which is not data wait
+        self.mark = timeit.default_timer()
+
+    def sample_process(self):
+        rss, open_fds = process_memory()
+        self.set('rss_bytes', rss)
+        if open_fds is not None:
+            self.set('open_fds', open_fds)
+
+    def series(self, name, phase, suffix='', extra=''):
+        labels = dict(self.labels)
+        if phase is not None:
+            labels['phase'] = phase
+        text = ','.join('%s="%s"' % (key, labels[key]) for key in sorted(labels))
+        return '%s_%s%s{%s%s}' % (self.namespace, name, suffix, text, extra)
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(name for name, phase in metrics)):
+                    lines.append('# TYPE %s_%s %s' % (self.namespace, name, kind))
+                    for (metric, phase), value in sorted(metrics.items(), key=lambda item: str(item[0])):
+                        if metric == name:
+                            lines.append('%s %r' % (self.series(name, phase), float(value)))
+            for name in sorted(set(name for name, phase in self.histograms)):
+                lines.append('# TYPE %s_%s histogram' % (self.namespace, name))
+                for (metric, phase), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(HISTOGRAM_BUCKETS + (float('inf'),), histogram['buckets']):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('%s %d' % (self.series(name, phase, '_bucket', ',le="%s"' % le), cumulative))
+                    lines.append('%s %r' % (self.series(name, phase, '_sum'), histogram['sum']))
+                    lines.append('%s %d' % (self.series(name, phase, '_count'), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''
+        The metrics as one JSON-serializable dict; histograms are summarized by count, sum and quantiles.
+        '''
+        record = dict(self.labels, time=time.time())
+        with self.lock:
+            for name, phase in list(self.counters) + list(self.gauges):
+                value = self.counters.get((name, phase), self.gauges.get((name, phase)))
+                record[name if phase is None else '%s.%s' % (phase, name)] = value
+            histograms = list(self.histograms.items())
+        for (name, phase), histogram in histograms:
+            record[name if phase is None else '%s.%s' % (phase, name)] = {
+                'count': histogram['count'], 'sum': histogram['sum'],
+                'p50': self.quantile(name, 0.5, phase), 'p99': self.quantile(name, 0.99, phase)}
+        return record
+
+    def export(self):
+        self.last_export = timeit.default_timer()
+        if self.prom_path is not None:
+            with open(self.prom_path + '.tmp', 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(self.prom_path + '.tmp', self.prom_path)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        '''
+        Serve the Prometheus text at http://host:port/metrics from a background thread. Only
+        local scrapers can reach it unless host is an external address ('' for all interfaces).
+        A server that an earlier Telemetry of this process started on the same address is
+        taken over, so re-running a cell does not fail with the address in use.
+        '''
+        if (host, port) in metrics_servers:
+            self.server = metrics_servers[(host, port)]
+            self.server.telemetry = self
+            return self.server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = self.server.telemetry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.telemetry = self
+        self.server.key = (host, port)
+        metrics_servers[self.server.key] = self.server
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        self.export()
+        if self.server is not None and self.server.telemetry is self:
+            self.server.shutdown()
+            self.server.server_close()
+            del metrics_servers[self.server.key]
+        self.server = None
+
+
+# Train fixed_model_3d with telemetry. The Prometheus file can be picked up by a node_exporter started with --collector.textfile.directory pointing at its directory; the endpoint can be scraped directly.
+
+# In[ ]:
+
+
+telemetry = Telemetry('train_3d', prom_path='train_3d.prom', jsonl_path='train_3d_metrics.jsonl', export_every=30)
+telemetry.serve(9108)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_train, num_epochs=3,
+         val_loader=clip_dataloader_val, val_every_epochs=1, metrics=telemetry)
+predict_ensemble(clip_dataloader_test, [], [fixed_model_3d], out_file=None, metrics=telemetry)
+print('step p50 %.3fs, p99 %.3fs, data wait p99 %.3fs'
+      % (telemetry.quantile('step_seconds', 0.5, 'train'), telemetry.quantile('step_seconds', 0.99, 'train'),
+         telemetry.quantile('data_wait_seconds', 0.99, 'train')))
+telemetry.close()
+
+
+# ### Large-batch training
+# 
+# On the CPU a batch of 16 or 32 clips leaves most of the width of the convolution kernels unused, and a larger batch gives more samples per second. Larger batches also mean fewer optimizer steps per epoch, and with the learning rate of a small batch training converges more slowly per sample. Three things make large batches work:
+# 
+# * gradient accumulation: train_loop(..., accum_steps=k) sums the gradients of k batches into one step, so the effective batch can be larger than what fits in memory or is fastest per batch;
+# * a larger learning rate (linearly with the batch size for SGD-like optimizers, with its square root for Adam-like ones) that is reached through a warmup: warmup_schedule raises it linearly over the first steps and then optionally decays it;
+# * layer-wise adaptive scaling: LARS (SGD with momentum) and LAMB (Adam) scale the update of every weight tensor so that its size is a fixed fraction of the weights' norm. Layers whose gradients are large compared to their weights then cannot diverge at the high learning rate. Biases and BatchNorm parameters are updated without the scaling and without weight decay.
+
+# In[ ]:
+
+
+import math
+
+def warmup_schedule(optimizer, warmup_steps, total_steps=None):
+    '''
+    LambdaLR that raises the learning rate linearly to its base value over warmup_steps
+    optimizer steps, then keeps it, or decays it linearly to 0 at total_steps if given.
+    '''
+    def factor(step):
+        if step < warmup_steps:
+            return float(step + 1) / warmup_steps
+        if total_steps is None:
+            return 1.0
+        return max(0.0, float(total_steps - step) / max(1, total_steps - warmup_steps))
+    return optim.lr_scheduler.LambdaLR(optimizer, factor)
+
+def trust_ratio(weight, update):
+    '''
+    ||weight|| / ||update||, or 1 where either norm is 0 (e.g. freshly zeroed layers).
+    '''
+    weight_norm, update_norm = weight.norm(), update.norm()
+    return torch.where((weight_norm > 0) & (update_norm > 0), weight_norm / update_norm,
+                       torch.ones_like(weight_norm))
+
+
+class LARS(optim.Optimizer):
+    """SGD with momentum and layer-wise adaptive rate scaling (You et al., 2017)."""
+
+    def __init__(self, params, lr, momentum=0.9, weight_decay=0.0, trust_coefficient=0.001):
+        """
+        Args:
+            params (iterable): parameters or parameter groups.
+            lr (float): global learning rate.
+            momentum (float): momentum factor.
+            weight_decay (float): L2 penalty of the weight tensors, not of biases and BatchNorm.
+            trust_coefficient (float): size of a step relative to the norm of the weights, before lr.
+        """
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay, trust_coefficient=trust_coefficient)
+        super(LARS, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                update = p.grad
+                if p.dim() > 1:
+                    update = update.add(p, alpha=group['weight_decay'])
+                    update = update * (group['trust_coefficient'] * trust_ratio(p, update))
+                state = self.state[p]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = update.clone()
+                else:
+                    state['momentum_buffer'].mul_(group['momentum']).add_(update)
+                p.add_(state['momentum_buffer'], alpha=-group['lr'])
+        return loss
+
+
+class LAMB(optim.Optimizer):
+    """Adam with layer-wise adaptive scaling of the update (You et al., 2019)."""
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0):
+        """
+        Args:
+            params (iterable): parameters or parameter groups.
+            lr (float): global learning rate.
+            betas (tuple): decay rates of the first and second moment estimates.
+            eps (float): added to the square root of the second moment.
+            weight_decay (float): decoupled weight decay of the weight tensors, not of biases and BatchNorm.
+        """
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(LAMB, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if not state:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+                state['exp_avg'].mul_(beta1).add_(p.grad, alpha=1 - beta1)
+                state['exp_avg_sq'].mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+                exp_avg = state['exp_avg'] / (1 - beta1 ** state['step'])
+                exp_avg_sq = state['exp_avg_sq'] / (1 - beta2 ** state['step'])
+                update = exp_avg / (exp_avg_sq.sqrt() + group['eps'])
+                if p.dim() > 1:
+                    update.add_(p, alpha=group['weight_decay'])
+                    update.mul_(trust_ratio(p, update))
+                p.add_(update, alpha=-group['lr'])
+        return loss
+
+
+# Compare the wall-clock time to a target validation accuracy at effective batch sizes 32, 256 and 1024, from the same initialization. Batches of up to max_batch samples are loaded at once (256 images, or 64 clips to bound the Conv3d activation memory) and larger effective batches are accumulated. fixed_model_base is trained with LARS, its learning rate scaled linearly with the batch size; fixed_model_3d with LAMB, its learning rate scaled with the square root. The warmup covers the first epoch, or at least 5 steps.
+
+# In[ ]:
+
+
+def large_batch_comparison(model, dataset, val_loader, get_batch, make_optimizer, base_lr, lr_scaling,
+                           target_acc, batch_sizes=(32, 256, 1024), max_batch=256, max_epochs=10):
+    '''
+    time_to_accuracy of model at every effective batch size in batch_sizes, from its current weights.
+    '''
+    initial_state = copy.deepcopy(model.state_dict())
+    results = {}
+    for batch_size in batch_sizes:
+        model.load_state_dict(initial_state)
+        loader_batch = min(batch_size, max_batch)
+        accum_steps = batch_size // loader_batch
+        loader = DataLoader(dataset, batch_size=loader_batch, shuffle=True, num_workers=4)
+        lr = base_lr * lr_scaling(batch_size / 32.0)
+        optimizer = make_optimizer(model.parameters(), lr)
+        steps_per_epoch = len(loader) // accum_steps
+        scheduler = warmup_schedule(optimizer, max(5, steps_per_epoch), max_epochs * steps_per_epoch)
+        results[batch_size] = time_to_accuracy(model, loss_fn, optimizer, loader, val_loader, get_batch,
+                                               target_acc, max_epochs, accum_steps=accum_steps, scheduler=scheduler)
+    model.load_state_dict(initial_state)
+    for batch_size in batch_sizes:
+        seconds, epochs = results[batch_size]
+        if seconds is None:
+            print('batch %4d: did not reach %.2f in %d epochs' % (batch_size, target_acc, epochs))
+        else:
+            print('batch %4d: reached %.2f in %d epochs, %.1f s' % (batch_size, target_acc, epochs, seconds))
+    return results
+
+torch.random.manual_seed(12345)
+fixed_model_base.cpu()
+fixed_model_base.apply(reset)
+large_batch_comparison(fixed_model_base, image_dataset_train, image_dataloader_val, image_batch,
+                       lambda params, lr: LARS(params, lr, weight_decay=5e-4), base_lr=0.1,
+                       lr_scaling=lambda k: k, target_acc=0.5)
+
+fixed_model_3d.apply(reset)
+large_batch_comparison(fixed_model_3d, clip_dataset_train, clip_dataloader_val, clip_batch,
+                       lambda params, lr: LAMB(params, lr, weight_decay=0.01), base_lr=1e-3,
+                       lr_scaling=math.sqrt, target_acc=0.5, max_batch=64)
+
+
+# ### Learning-rate range test and one-cycle training
+# 
+# The learning rates above were picked by hand, and Adadelta at lr=1e-4 hardly changes the weights in one epoch. lr_range_test trains a copy of the model for a few hundred steps while raising the learning rate exponentially from min_lr to max_lr, and records the smoothed training loss. The loss first stays flat (learning rate too small), then falls, and finally blows up. The test stops there and recommends max_lr, a tenth of the learning rate with the lowest loss, as the peak of a one-cycle schedule, with base_lr = max_lr / 25 as its start. The model and its optimizer are not changed.
+# 
+# one_cycle_schedule warms the learning rate up from base_lr to max_lr over the first 30% of the steps and anneals it with a cosine to nearly 0, cycling the momentum the other way if the optimizer has one. cosine_schedule is the same without the warmup-to-peak shape, after an optional linear warmup. Pass max_lr to train / train_3d and the whole run is one cycle; any schedule can also be passed as scheduler.
+
+# In[ ]:
+
+
+def one_cycle_schedule(optimizer, max_lr, total_steps, pct_start=0.3):
+    defaults = optimizer.defaults
+    cycle_momentum = defaults.get('momentum', 0) > 0 or 'betas' in defaults
+    return optim.lr_scheduler.OneCycleLR(optimizer, max_lr, total_steps=total_steps, pct_start=pct_start,
+                                         anneal_strategy='cos', cycle_momentum=cycle_momentum)
+
+def cosine_schedule(optimizer, total_steps, warmup_steps=0, min_ratio=0.0):
+    '''
+    LambdaLR: linear warmup over warmup_steps, then cosine decay of the learning rate
+    from its base value to min_ratio times it at total_steps.
+    '''
+    def factor(step):
+        if step < warmup_steps:
+            return float(step + 1) / warmup_steps
+        progress = min(1.0, float(step - warmup_steps) / max(1, total_steps - warmup_steps))
+        return min_ratio + (1 - min_ratio) * 0.5 * (1 + math.cos(math.pi * progress))
+    return optim.lr_scheduler.LambdaLR(optimizer, factor)
+
+def lr_range_test(model, loss_fn, optimizer, dataloader, get_batch, min_lr=1e-7, max_lr=10.0, num_steps=200,
+                  smoothing=0.05, diverge=4.0):
+    '''
+    Train a copy of model with a copy of optimizer while the learning rate grows exponentially
+    from min_lr to max_lr over num_steps steps (the loader is restarted as needed). Stops once
+    the smoothed loss exceeds diverge times its minimum, or is no longer finite. Returns a dict with the tried 'lrs',
+    the smoothed 'losses', 'best_lr' (lowest loss) and the recommended 'max_lr' and 'base_lr'.
+    '''
+    model_copy = copy.deepcopy(model)
+    model_copy.train()
+    # an optimizer of the same type and settings, for the parameters of the copy
+    test_optimizer = optimizer.__class__(model_copy.parameters(), **optimizer.defaults)
+    gamma = (float(max_lr) / min_lr) ** (1.0 / max(1, num_steps - 1))
+    lrs, losses = [], []
+    smoothed, best_loss = 0.0, float('inf')
+    batches = iter(dataloader)
+    for step in range(num_steps):
+        lr = min_lr * gamma ** step
+        for group in test_optimizer.param_groups:
+            group['lr'] = lr
+        try:
+            sample = next(batches)
+        except StopIteration:
+            batches = iter(dataloader)
+            sample = next(batches)
+        x_var, y_var = get_batch(sample)
+        loss = loss_fn(model_copy(x_var), y_var)
+        test_optimizer.zero_grad()
+        loss.backward()
+        test_optimizer.step()
+
+        # bias-corrected exponential moving average, as in Adam
+        smoothed = (1 - smoothing) * smoothed + smoothing * loss.item()
+        value = smoothed / (1 - (1 - smoothing) ** (step + 1))
+        lrs.append(lr)
+        losses.append(value)
+        best_loss = min(best_loss, value)
+        # the first tenth of the sweep is too noisy to call a divergence
+        if not math.isfinite(value) or (step >= num_steps // 10 and value > diverge * best_loss):
+            break
+    best_lr = lrs[int(np.argmin(losses))]
+    result = {'lrs': lrs, 'losses': losses, 'best_lr': best_lr, 'max_lr': best_lr / 10, 'base_lr': best_lr / 250}
+    print('LR range test: lowest loss %.4f at lr %.2e after %d steps; recommended max_lr %.2e, base_lr %.2e'
+          % (min(losses), best_lr, len(lrs), result['max_lr'], result['base_lr']))
+    return result
+
+
+# Find the learning rate range of fixed_model_3d with RMSprop and of fixed_model_base with SGD, then train each for a single one-cycle run of 3 epochs instead of many epochs at a hand-picked rate.
+
+# In[ ]:
+
+
+torch.random.manual_seed(12345)
+fixed_model_3d.apply(reset)
+optimizer = optim.RMSprop(fixed_model_3d.parameters(), lr=1e-4)
+lr_range_3d = lr_range_test(fixed_model_3d, loss_fn, optimizer, clip_dataloader_train, clip_batch,
+                            min_lr=1e-7, max_lr=1.0, num_steps=300)
+train_3d(fixed_model_3d, loss_fn, optimizer, clip_dataloader_train, num_epochs=3, max_lr=lr_range_3d['max_lr'],
+         val_loader=clip_dataloader_val, val_every_epochs=1)
+
+fixed_model_base.cpu()
+fixed_model_base.apply(reset)
+optimizer = optim.SGD(fixed_model_base.parameters(), lr=1e-3, momentum=0.9, weight_decay=5e-4)
+lr_range_base = lr_range_test(fixed_model_base, loss_fn, optimizer, image_dataloader_train, image_batch,
+                              min_lr=1e-6, max_lr=10.0, num_steps=300)
+train_loop(fixed_model_base, loss_fn, optimizer, image_dataloader_train, image_batch, num_epochs=3,
+           max_lr=lr_range_base['max_lr'], val_loader=image_dataloader_val, val_every_epochs=1)